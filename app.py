@@ -1,15 +1,112 @@
-
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter, ImageOps
+from PIL import Image
 import os
-import io
 import random
-import datetime
-import zipfile
-import numpy as np
-import logging
+import json
+
+from render import list_files, RENDITIONS
+from engine import iter_batch, default_workers, merge_stats, text_sprite_hit_rate, render_cache_hit_rate
+from export import ZipExporter, save_output, output_mime_type
+from ingest import Manifest, DirectoryIngest, MANIFEST_NAME
+from store import ResultStore, sweep_stale
+from timings import BatchProfile, stage, take_events
 
 # =================== CONFIG ===================
+PREVIEW_SIZE = (360, 480)
+PAGE_SIZE = 12
+COLS_PER_ROW = 3
+# Server Folder paths must resolve inside this folder; anyone with the page
+# open could otherwise read and write anywhere the server can
+PHOTO_ROOT = os.path.realpath(os.environ.get("PHOTO_ROOT", "photos"))
+
+# =================== CACHED ASSETS ===================
+# Every widget change reruns this script; these keep folder scans and image
+# decodes from repeating. Entries are shared across sessions, so the images
+# handed out must be treated as read-only.
+@st.cache_resource(show_spinner=False)
+def _list_assets(folder, exts, mtime):
+    return list_files(folder, list(exts))
+
+def list_assets(folder, exts):
+    """list_files, rescanned only when the folder's mtime changes"""
+    mtime = os.stat(folder).st_mtime_ns if os.path.isdir(folder) else None
+    return _list_assets(folder, tuple(exts), mtime)
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _load_rgba(path, mtime):
+    with Image.open(path) as img:
+        return img.convert("RGBA")
+
+def load_rgba(path):
+    """Decoded RGBA asset, reloaded only when the file's mtime changes"""
+    return _load_rgba(path, os.stat(path).st_mtime_ns)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _decode_upload_rgba(file_id, _upload):
+    return Image.open(_upload).convert("RGBA")
+
+def upload_rgba(upload):
+    """Decoded RGBA of an uploaded file, memoized by its upload id"""
+    return _decode_upload_rgba(upload.file_id, upload)
+
+@st.cache_resource(show_spinner=False)
+def sweep_temp_files():
+    """Once per server process: remove outputs earlier servers left in the temp dir"""
+    sweep_stale()
+
+# =================== FOLDER BATCHES ===================
+def resolve_folder(path):
+    """path relative to PHOTO_ROOT, resolved, or None if it leads outside it"""
+    resolved = os.path.realpath(os.path.join(PHOTO_ROOT, path))
+    if os.path.commonpath([resolved, PHOTO_ROOT]) != PHOTO_ROOT:
+        return None
+    return resolved
+
+def process_folder(settings, input_dir, output_dir, workers, profile=False):
+    """Render the new photos in input_dir straight into output_dir.
+
+    Photos are read one at a time and outputs saved as they finish, so
+    nothing from the batch is held in the session however many photos
+    there are. The manifest in output_dir makes the next run skip photos
+    that are already done (see ingest). Returns (stats, BatchProfile).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    inputs = DirectoryIngest(input_dir, manifest)
+    total = inputs.pending()
+    batch_stats = {}
+    batch_profile = BatchProfile()
+    if not total:
+        manifest.close()
+        st.info(f"No new photos in {input_dir} ({inputs.skipped} already done)")
+        return batch_stats, batch_profile
+
+    progress_bar = st.progress(0.0)
+    live_cols = st.columns(COLS_PER_ROW)
+    written = 0
+    take_events()
+    try:
+        results = iter_batch(inputs, settings, max(1, min(workers, total)), preview_size=PREVIEW_SIZE, profile=profile)
+        for done, (index, name, outputs, error, stats) in enumerate(results, 1):
+            merge_stats(batch_stats, stats)
+            paths = []
+            if error is None:
+                for filename, data, preview in outputs:
+                    with stage("zip"):
+                        paths.append(save_output(output_dir, filename, data))
+                    if written < PAGE_SIZE:
+                        live_cols[written % COLS_PER_ROW].image(preview, caption=filename, use_column_width=True)
+                    written += 1
+            else:
+                st.error(f"Error processing {name}: {error}")
+            inputs.done(name, paths, error)
+            batch_profile.add(name, stats.get('timings', []) + take_events(), stats.get('cprofile'))
+            progress_bar.progress(done / total, text=f"Processed {done}/{total}: {name}")
+    finally:
+        manifest.close()
+    st.success(f"Wrote {written} photos to {output_dir} ({inputs.skipped} already done)")
+    return batch_stats, batch_profile
+
 st.set_page_config(page_title="⚡ EDIT 100+ IMAGE IN ONE CLICK", layout="wide")
 
 # Custom CSS for black/yellow theme with specific areas having black background
@@ -91,333 +188,44 @@ st.markdown("""
     </div>
 """, unsafe_allow_html=True)
 
-# =================== UTILS ===================
-def list_files(folder, exts):
-    """List files in folder with given extensions"""
-    if not os.path.exists(folder):
-        os.makedirs(folder, exist_ok=True)
-        return []
-    return [f for f in os.listdir(folder) 
-           if any(f.lower().endswith(ext.lower()) for ext in exts)]
-
-def smart_crop(img, target_ratio=3/4):
-    w, h = img.size
-    if w/h > target_ratio:
-        new_w = int(h * target_ratio)
-        left = (w - new_w) // 2
-        return img.crop((left, 0, left + new_w, h))
-    else:
-        new_h = int(w / target_ratio)
-        top = (h - new_h) // 2
-        return img.crop((0, top, w, top + new_h))
-
-def get_text_size(draw, text, font):
-    bbox = draw.textbbox((0, 0), text, font=font)
-    return bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-def get_random_font():
-    fonts = list_files("assets/fonts", [".ttf", ".otf"])
-    if not fonts:
-        return None  # Return None if no fonts available
-    
-    max_attempts = 3
-    for attempt in range(max_attempts):
-        try:
-            font_path = os.path.join("assets/fonts", random.choice(fonts))
-            if os.path.exists(font_path):
-                return ImageFont.truetype(font_path, 80)
-        except Exception as e:
-            logging.warning(f"Failed to load font (attempt {attempt+1}): {str(e)}")
-            continue
-    
-    return None  # Return None if all attempts fail
-
-def get_random_wish(greeting_type):
-    wishes = {
-        "Good Morning": ["Rise and shine!", "Make today amazing!", "Morning blessings!", "New day, new blessings!"],
-        "Good Afternoon": ["Enjoy your day!", "Afternoon delights!", "Sunshine and smiles!", "Perfect day ahead!"],
-        "Good Evening": ["Beautiful sunset!", "Evening serenity!", "Twilight magic!", "Peaceful evening!"],
-        "Good Night": ["Sweet dreams!", "Sleep tight!", "Night night!", "Rest well!"]
-    }
-    return random.choice(wishes.get(greeting_type, ["Have a nice day!"]))
-
-def get_random_color():
-    return random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
-
-def apply_text_effect(draw, position, text, font, effect_settings, texture_img=None):
-    x, y = position
-    effect_type = effect_settings['type']
-    
-    # For full random, we'll use the same color for all text in the image
-    if effect_type == 'full_random':
-        main_color = effect_settings.get('main_color', (255, 255, 255))
-        outline_color = effect_settings.get('outline_color', (0, 0, 0))
-    else:
-        main_color = effect_settings.get('main_color', (255, 255, 255))
-        outline_color = effect_settings.get('outline_color', (0, 0, 0))
-    
-    if effect_settings.get('use_texture', False) and texture_img:
-        mask = Image.new("L", (font.getsize(text)[0], font.getsize(text)[1]))
-        mask_draw = ImageDraw.Draw(mask)
-        mask_draw.text((0, 0), text, font=font, fill=255)
-        texture = texture_img.resize(mask.size)
-        textured_text = Image.new("RGBA", mask.size)
-        textured_text.paste(texture, (0, 0), mask)
-        draw.bitmap((x, y), textured_text.convert("L"), fill=(255, 255, 255))
-        return effect_settings
-    
-    if effect_type == "white_only":
-        draw.text((x, y), text, font=font, fill=main_color)
-    elif effect_type == "white_black_outline":
-        outline_size = 2
-        for ox in range(-outline_size, outline_size+1):
-            for oy in range(-outline_size, outline_size+1):
-                if ox != 0 or oy != 0:
-                    draw.text((x+ox, y+oy), text, font=font, fill=outline_color)
-        draw.text((x, y), text, font=font, fill=main_color)
-    elif effect_type == "full_random":
-        # 50% chance for white or white with black outline
-        if random.random() < 0.5:
-            draw.text((x, y), text, font=font, fill=main_color)
-        else:
-            outline_size = 2
-            for ox in range(-outline_size, outline_size+1):
-                for oy in range(-outline_size, outline_size+1):
-                    if ox != 0 or oy != 0:
-                        draw.text((x+ox, y+oy), text, font=font, fill=outline_color)
-            draw.text((x, y), text, font=font, fill=main_color)
-    
-    return effect_settings
-
-def format_date(date_format="%d %B %Y", show_day=False):
-    today = datetime.datetime.now()
-    formatted_date = today.strftime(date_format)
-    
-    if show_day:
-        if today.hour >= 19:
-            next_day = today + datetime.timedelta(days=1)
-            day_name = next_day.strftime("%A")
-            formatted_date += f" (Advance {day_name})"
-        else:
-            day_name = today.strftime("%A")
-            formatted_date += f" ({day_name})"
-    
-    return formatted_date
-
-def apply_overlay(image, overlay_path, size=0.5):
-    try:
-        overlay = Image.open(overlay_path).convert("RGBA")
-        new_size = (int(image.width * size), int(image.height * size))
-        overlay = overlay.resize(new_size, Image.LANCZOS)
-        
-        max_x = max(20, image.width - overlay.width - 20)
-        max_y = max(20, image.height - overlay.height - 20)
-        x = random.randint(20, max_x) if max_x > 20 else 20
-        y = random.randint(20, max_y) if max_y > 20 else 20
-        
-        image.paste(overlay, (x, y), overlay)
-    except Exception as e:
-        st.error(f"Error applying overlay: {str(e)}")
-    return image
-
-def generate_filename():
-    now = datetime.datetime.now()
-    future_minutes = random.randint(1, 10)
-    future_time = now + datetime.timedelta(minutes=future_minutes)
-    return f"Picsart_{future_time.strftime('%y-%m-%d_%H-%M-%S')}.jpg"
-
-def get_watermark_position(img, watermark):
-    if random.random() < 0.7:
-        x = random.choice([20, max(20, img.width - watermark.width - 20)])
-        y = max(20, img.height - watermark.height - 20)
-    else:
-        max_x = max(20, img.width - watermark.width - 20)
-        max_y = max(20, img.height - watermark.height - 20)
-        x = random.randint(20, max_x) if max_x > 20 else 20
-        y = random.randint(20, max_y) if max_y > 20 else 20
-    
-    return (x, y)
-
-def enhance_image_quality(img):
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    img = ImageEnhance.Sharpness(img).enhance(1.5)
-    img = ImageEnhance.Contrast(img).enhance(1.1)
-    
-    hist = img.histogram()
-    if sum(hist[:100]) > sum(hist[-100:]):
-        img = ImageEnhance.Brightness(img).enhance(1.1)
-    
-    return img
-
-def upscale_text_elements(img, scale_factor=2):
-    if scale_factor > 1:
-        new_size = (img.width * scale_factor, img.height * scale_factor)
-        img = img.resize(new_size, Image.LANCZOS)
-    return img
-
-def create_variant(original_img, settings):
-    img = original_img.copy()
-    draw = ImageDraw.Draw(img)
-    
-    # Get font - if None, return None to indicate failure
-    font = get_random_font()
-    if font is None:
-        return None
-    
-    texture_img = None
-    if settings.get('use_texture', False) and settings.get('texture_image', None):
-        texture_img = settings['texture_image']
-    
-    effect_settings = {
-        'type': settings.get('text_effect', None),
-        'use_texture': settings.get('use_texture', False)
-    }
-    
-    if effect_settings['type'] == 'full_random':
-        # For full random, we'll use the same color for all text in the image
-        effect_settings['main_color'] = (255, 255, 255)  # Always white for main text
-        effect_settings['outline_color'] = (0, 0, 0)  # Always black for outline
-    
-    if settings['show_text']:
-        font_main = font.font_variant(size=settings['main_size'])
-        text = settings['greeting_type']
-        text_width, text_height = get_text_size(draw, text, font_main)
-        
-        max_text_x = max(20, img.width - text_width - 20)
-        text_x = random.randint(20, max_text_x) if max_text_x > 20 else 20
-        max_text_y = max(20, img.height // 3)
-        text_y = random.randint(20, max_text_y) if max_text_y > 20 else 20
-        
-        effect_settings = apply_text_effect(
-            draw, 
-            (text_x, text_y), 
-            text, 
-            font_main,
-            effect_settings,
-            texture_img=texture_img
-        )
-    
-    if settings['show_wish']:
-        font_wish = font.font_variant(size=settings['wish_size'])
-        wish_text = get_random_wish(settings['greeting_type'])
-        wish_width, wish_height = get_text_size(draw, wish_text, font_wish)
-        
-        if settings['show_text']:
-            max_wish_x = max(20, img.width - wish_width - 20)
-            wish_x = random.randint(20, max_wish_x) if max_wish_x > 20 else 20
-            wish_y = text_y + settings['main_size'] + random.randint(10, 30)
-        else:
-            max_wish_x = max(20, img.width - wish_width - 20)
-            wish_x = random.randint(20, max_wish_x) if max_wish_x > 20 else 20
-            max_wish_y = max(20, img.height // 2)
-            wish_y = random.randint(20, max_wish_y) if max_wish_y > 20 else 20
-        
-        apply_text_effect(
-            draw, 
-            (wish_x, wish_y), 
-            wish_text, 
-            font_wish,
-            effect_settings,
-            texture_img=texture_img
-        )
-    
-    if settings['show_date']:
-        font_date = font.font_variant(size=settings['date_size'])
-        
-        if settings['date_format'] == "8 July 2025":
-            date_text = format_date("%d %B %Y", settings['show_day'])
-        elif settings['date_format'] == "28 January 2025":
-            date_text = format_date("%d %B %Y", settings['show_day'])
-        elif settings['date_format'] == "07/08/2025":
-            date_text = format_date("%m/%d/%Y", settings['show_day'])
-        else:
-            date_text = format_date("%Y-%m-%d", settings['show_day'])
-            
-        date_width, date_height = get_text_size(draw, date_text, font_date)
-        
-        max_date_x = max(20, img.width - date_width - 20)
-        date_x = random.randint(20, max_date_x) if max_date_x > 20 else 20
-        date_y = max(20, img.height - date_height - 20)
-        
-        if settings['show_day'] and "(" in date_text:
-            day_part = date_text[date_text.index("("):]
-            day_width, _ = get_text_size(draw, day_part, font_date)
-            if date_x + day_width > img.width - 20:
-                date_x = img.width - day_width - 25
-        
-        apply_text_effect(
-            draw, 
-            (date_x, date_y), 
-            date_text, 
-            font_date,
-            effect_settings,
-            texture_img=texture_img
-        )
-    
-    if settings['use_watermark'] and settings['watermark_image']:
-        watermark = settings['watermark_image'].copy()
-        
-        if settings['watermark_opacity'] < 1.0:
-            alpha = watermark.split()[3]
-            alpha = ImageEnhance.Brightness(alpha).enhance(settings['watermark_opacity'])
-            watermark.putalpha(alpha)
-        
-        watermark.thumbnail((img.width//4, img.height//4))
-        pos = get_watermark_position(img, watermark)
-        img.paste(watermark, pos, watermark)
-    
-    if settings['use_coffee_pet'] and settings['selected_pet']:
-        pet_path = os.path.join("assets/pets", settings['selected_pet'])
-        if os.path.exists(pet_path):
-            pet_img = Image.open(pet_path).convert("RGBA")
-            pet_img = pet_img.resize(
-                (int(img.width * settings['pet_size']), 
-                int(img.height * settings['pet_size'] * (pet_img.height/pet_img.width))),
-                Image.LANCZOS
-            )
-            x = img.width - pet_img.width - 20
-            y = img.height - pet_img.height - 20
-            img.paste(pet_img, (x, y), pet_img)
-    
-    img = enhance_image_quality(img)
-    img = upscale_text_elements(img, scale_factor=2)
-    
-    return img.convert("RGB")
-
-def adjust_font_size_to_fit(draw, text, max_width, max_height, initial_size):
-    font = None
-    size = initial_size
-    while size > 10:
-        try:
-            font = ImageFont.truetype("assets/fonts/default.ttf", size)
-            text_width, text_height = get_text_size(draw, text, font)
-            if text_width <= max_width and text_height <= max_height:
-                break
-        except:
-            font = ImageFont.load_default()
-            break
-        size -= 2
-    return font
 
 # =================== MAIN APP ===================
+sweep_temp_files()
 if 'generated_images' not in st.session_state:
-    st.session_state.generated_images = []
+    st.session_state.generated_images = ResultStore()
+if 'zip_export' not in st.session_state:
+    st.session_state.zip_export = None
+if 'batch_profile' not in st.session_state:
+    st.session_state.batch_profile = None
+if 'download_index' not in st.session_state:
+    st.session_state.download_index = None
 
-uploaded_images = st.file_uploader("📁 Upload Images", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+input_source = st.radio("Input Source", ["Upload", "Server Folder"], horizontal=True,
+                        help="Server Folder reads photos from a folder on this machine and writes the "
+                             "results to another, for batches too large to upload")
+uploaded_images = []
+if input_source == "Upload":
+    uploaded_images = st.file_uploader("📁 Upload Images", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+else:
+    folder_cols = st.columns(2)
+    folder_help = f"Inside {PHOTO_ROOT} (set PHOTO_ROOT to change)"
+    input_dir = resolve_folder(folder_cols[0].text_input("📁 Input Folder", value="input", help=folder_help))
+    output_dir = resolve_folder(folder_cols[1].text_input("💾 Output Folder", value="output", help=folder_help))
 
 with st.sidebar:
     st.markdown("### ⚙️ Settings")
     
     greeting_type = st.selectbox("Greeting Type", ["Good Morning", "Good Afternoon", "Good Evening", "Good Night"])
     generate_variants = st.checkbox("Generate 3 Variants per Photo", value=False)
+    avoid_faces = st.checkbox("Keep Text Off Faces", value=True)
     
     text_effect = st.selectbox(
         "Text Style",
         ["White Only", "White with Black Outline", "Full Random"],
         index=0
     )
+    if text_effect != "White Only":
+        outline_width = st.slider("Outline Width", 1, 10, 2)
     
     st.markdown("### 🎨 Texture Options")
     use_texture = st.checkbox("Use Texture for Text", value=False)
@@ -427,14 +235,14 @@ with st.sidebar:
         texture_option = st.radio("Texture Source", ["From Uploaded Images", "Pre-made Texture"])
         
         if texture_option == "From Uploaded Images" and uploaded_images:
-            texture_image = Image.open(uploaded_images[0]).convert("RGBA")
+            texture_image = upload_rgba(uploaded_images[0])
         elif texture_option == "Pre-made Texture":
-            texture_files = list_files("assets/textures", [".png", ".jpg", ".jpeg"])
+            texture_files = list_assets("assets/textures", [".png", ".jpg", ".jpeg"])
             if texture_files:
                 selected_texture = st.selectbox("Select Texture", texture_files)
                 texture_path = os.path.join("assets/textures", selected_texture)
                 if os.path.exists(texture_path):
-                    texture_image = Image.open(texture_path).convert("RGBA")
+                    texture_image = load_rgba(texture_path)
     
     show_text = st.checkbox("Show Greeting", value=True)
     if show_text:
@@ -459,7 +267,7 @@ with st.sidebar:
         watermark_option = st.radio("Watermark Source", ["Pre-made", "Upload Your Own"])
         
         if watermark_option == "Pre-made":
-            watermark_files = list_files("assets/logos", [".png", ".jpg", ".jpeg"])
+            watermark_files = list_assets("assets/logos", [".png", ".jpg", ".jpeg"])
             if watermark_files:
                 # Default to "wishful vibes.png" if available
                 default_index = 0
@@ -468,7 +276,7 @@ with st.sidebar:
                 selected_watermark = st.selectbox("Select Watermark", watermark_files, index=default_index)
                 watermark_path = os.path.join("assets/logos", selected_watermark)
                 if os.path.exists(watermark_path):
-                    watermark_image = Image.open(watermark_path).convert("RGBA")
+                    watermark_image = load_rgba(watermark_path)
                 else:
                     st.error(f"Watermark file not found: {watermark_path}")
             else:
@@ -476,7 +284,7 @@ with st.sidebar:
         else:
             uploaded_watermark = st.file_uploader("Upload Watermark", type=["png"])
             if uploaded_watermark:
-                watermark_image = Image.open(uploaded_watermark).convert("RGBA")
+                watermark_image = upload_rgba(uploaded_watermark)
         
         watermark_opacity = st.slider("Watermark Opacity", 0.1, 1.0, 1.0)
     
@@ -491,8 +299,6 @@ with st.sidebar:
                 overlay_files = ["1.png", "2.png"]
             else:
                 overlay_files = ["1.png", "3.png"]
-        else:
-            overlay_files = random.sample(["1.png", "2.png", "3.png", "4.png", "5.png"], 2)
         
         overlay_size = st.slider("Overlay Size", 0.1, 1.0, 0.5)
     
@@ -501,18 +307,57 @@ with st.sidebar:
     use_coffee_pet = st.checkbox("Enable Coffee & Pet PNG", value=False)
     if use_coffee_pet:
         pet_size = st.slider("PNG Size", 0.1, 1.0, 0.3)
-        pet_files = list_files("assets/pets", [".png", ".jpg", ".jpeg"])
+        pet_files = list_assets("assets/pets", [".png", ".jpg", ".jpeg"])
         selected_pet = st.selectbox("Select Pet PNG", ["Random"] + pet_files)
-        
-        if selected_pet == "Random":
-            selected_pet = random.choice(pet_files) if pet_files else None
+    
+    st.markdown("---")
+    st.markdown("### 💾 Output")
+    renditions = st.multiselect("Renditions", list(RENDITIONS), default=[],
+                                help="Story 9:16, square 1:1 and portrait 3:4 versions of each photo with the "
+                                     "same text and layout, grouped per photo in the ZIP. Empty makes one 3:4 photo.")
+    output_format = st.selectbox("Format", ["JPEG", "WebP"], index=0,
+                                 help="WebP files are usually much smaller at the same quality")
+    output_quality = st.slider("Quality", 30, 100, 95)
+    jpeg_optimize = jpeg_progressive = False
+    jpeg_subsampling = None
+    if output_format == "JPEG":
+        jpeg_optimize = st.checkbox("Optimize (smaller, slightly slower)", value=False)
+        jpeg_progressive = st.checkbox("Progressive", value=False)
+        subsampling = st.selectbox("Chroma Subsampling", ["Default", "4:4:4", "4:2:2", "4:2:0"], index=0,
+                                   help="4:2:0 is smallest; 4:4:4 keeps colored text edges sharpest")
+        jpeg_subsampling = None if subsampling == "Default" else subsampling
+    max_kb = st.number_input("Max File Size (KB, 0 = no limit)", min_value=0, value=0, step=50,
+                             help="Lowers the quality per image until the file fits")
+    
+    st.markdown("---")
+    st.markdown("### 🚀 Performance")
+    # A slider needs min < max, so single-CPU hosts get no choice
+    worker_count = 1
+    if default_workers() > 1:
+        worker_count = st.slider("Worker Processes", 1, default_workers(), default_workers())
+    working_width = st.slider("Working Width (px)", 540, 2160, 1080, step=90)
+    render_at_output_size = st.checkbox("Draw Text at Output Size (sharper, faster)", value=True)
+    deterministic = st.checkbox("Repeatable Results (reuse cached renders)", value=True)
+    if deterministic:
+        seed = st.number_input("Random Seed", min_value=0, value=0, step=1,
+                               help="Change to get a different layout for the same photos")
+    
+    # Random overlay and pet picks come from the seed when results are
+    # repeatable, so the next click has the same settings and hits the cache
+    picker = random.Random(int(seed)) if deterministic else random
+    if use_overlay and random_overlay:
+        overlay_files = picker.sample(["1.png", "2.png", "3.png", "4.png", "5.png"], 2)
+    if use_coffee_pet and selected_pet == "Random":
+        selected_pet = picker.choice(pet_files) if pet_files else None
+    profile_batch = st.checkbox("Profile with cProfile (slower)", value=False)
 
 if st.button("✨ Generate Photos", key="generate"):
-    if uploaded_images:
+    if input_source == "Server Folder" and (input_dir is None or output_dir is None):
+        st.warning(f"Input and output folders must be inside {PHOTO_ROOT}")
+    elif input_source == "Server Folder" and not os.path.isdir(input_dir):
+        st.warning(f"Input folder not found: {input_dir}")
+    elif uploaded_images or input_source == "Server Folder":
         with st.spinner("Processing images..."):
-            processed_images = []
-            variant_images = []
-            
             effect_mapping = {
                 "White Only": "white_only",
                 "White with Black Outline": "white_black_outline",
@@ -522,6 +367,7 @@ if st.button("✨ Generate Photos", key="generate"):
             
             settings = {
                 'greeting_type': greeting_type,
+                'generate_variants': generate_variants,
                 'show_text': show_text,
                 'main_size': main_size if show_text else 90,  # Default 90
                 'show_wish': show_wish,
@@ -541,192 +387,126 @@ if st.button("✨ Generate Photos", key="generate"):
                 'pet_size': pet_size if use_coffee_pet else 0.3,
                 'selected_pet': selected_pet if use_coffee_pet else None,
                 'text_effect': selected_effect,
+                'outline_width': outline_width if text_effect != "White Only" else 2,
+                'working_width': working_width,
+                'output_scale': 2,
+                'render_at_output_size': render_at_output_size,
                 'use_texture': use_texture,
-                'texture_image': texture_image
+                'texture_image': texture_image,
+                'avoid_faces': avoid_faces,
+                'seed': int(seed) if deterministic else None,
+                'output_format': output_format.lower(),
+                'output_quality': output_quality,
+                'jpeg_optimize': jpeg_optimize,
+                'jpeg_progressive': jpeg_progressive,
+                'jpeg_subsampling': jpeg_subsampling,
+                'max_kb': int(max_kb) or None,
+                'renditions': renditions
             }
             
-            for uploaded_file in uploaded_images:
-                try:
-                    if uploaded_file is None:
-                        continue
-                        
-                    img = Image.open(uploaded_file)
-                    if img is None:
-                        raise ValueError("Could not open image")
-                        
-                    img = img.convert("RGBA")
-                    img = smart_crop(img)
-                    img = enhance_image_quality(img)
-                    
-                    if use_overlay:
-                        for overlay_file in overlay_files:
-                            overlay_path = os.path.join("assets/overlays", overlay_theme, overlay_file)
-                            if os.path.exists(overlay_path):
-                                img = apply_overlay(img, overlay_path, overlay_size)
-                            else:
-                                st.warning(f"Overlay file not found: {overlay_path}")
-                    
-                    if generate_variants:
-                        variants = []
-                        for i in range(3):
-                            variant = create_variant(img, settings)
-                            if variant is not None:  # Only add if font selection succeeded
-                                variants.append((generate_filename(), variant))
-                        variant_images.extend(variants)
+            if input_source == "Server Folder":
+                batch_stats, batch_profile = process_folder(settings, input_dir, output_dir, worker_count, profile_batch)
+                st.session_state.batch_profile = batch_profile
+                st.caption(f"Text sprite cache hit rate: {text_sprite_hit_rate(batch_stats):.0%}")
+                if deterministic:
+                    st.caption(f"Render cache hit rate: {render_cache_hit_rate(batch_stats):.0%}")
+            else:
+                uploads = [(f.name, f.getvalue()) for f in uploaded_images if f is not None]
+                progress_bar = st.progress(0.0)
+            
+                if st.session_state.zip_export is not None:
+                    st.session_state.zip_export.discard()
+                zip_export = ZipExporter()
+                st.session_state.generated_images.clear()
+                generated_images = ResultStore.spilled()
+                st.session_state.download_index = None
+                st.session_state.preview_page = 1
+            
+                # Thumbnails of the first page appear here as images finish; the
+                # paginated grid below replaces them once the batch is done
+                live_preview = st.empty()
+                live_cols = live_preview.container().columns(COLS_PER_ROW)
+            
+                batch_stats = {}
+                batch_profile = BatchProfile()
+                take_events()
+                workers = max(1, min(worker_count, len(uploads)))
+                results = iter_batch(uploads, settings, workers, preview_size=PREVIEW_SIZE, profile=profile_batch)
+                # Previews show in completion order, but the ZIP and the stored
+                # results follow upload order: an image that finishes early
+                # waits in finished until every upload before it is written
+                finished = {}
+                next_index = 0
+                shown = 0
+                for done, (index, name, outputs, error, stats) in enumerate(results, 1):
+                    merge_stats(batch_stats, stats)
+                    if error is None:
+                        for filename, data, preview in outputs:
+                            if shown < PAGE_SIZE:
+                                live_cols[shown % COLS_PER_ROW].image(preview, caption=filename, use_column_width=True)
+                            shown += 1
                     else:
-                        draw = ImageDraw.Draw(img)
-                        font = get_random_font()
-                        if font is None:
-                            st.error(f"Failed to load any fonts for {uploaded_file.name}. Please check your fonts folder.")
-                            continue
-                        
-                        effect_settings = {
-                            'type': selected_effect,
-                            'use_texture': use_texture
-                        }
-                        
-                        if selected_effect == 'full_random':
-                            effect_settings['main_color'] = (255, 255, 255)  # Always white for main text
-                            effect_settings['outline_color'] = (0, 0, 0)  # Always black for outline
-                        
-                        if show_text:
-                            font_main = font.font_variant(size=main_size)
-                            text = greeting_type
-                            text_width, text_height = get_text_size(draw, text, font_main)
-                            
-                            if text_width > img.width - 40:
-                                font_main = adjust_font_size_to_fit(draw, text, img.width - 40, img.height//3, main_size)
-                                text_width, text_height = get_text_size(draw, text, font_main)
-                            
-                            text_x = (img.width - text_width) // 2
-                            text_y = 20
-                            
-                            effect_settings = apply_text_effect(
-                                draw, 
-                                (text_x, text_y), 
-                                text, 
-                                font_main,
-                                effect_settings,
-                                texture_img=texture_image
-                            )
-                        
-                        if show_wish:
-                            font_wish = font.font_variant(size=wish_size)
-                            wish_text = get_random_wish(greeting_type)
-                            wish_width, wish_height = get_text_size(draw, wish_text, font_wish)
-                            
-                            if wish_width > img.width - 40:
-                                font_wish = adjust_font_size_to_fit(draw, wish_text, img.width - 40, img.height//3, wish_size)
-                                wish_width, wish_height = get_text_size(draw, wish_text, font_wish)
-                            
-                            wish_x = (img.width - wish_width) // 2
-                            wish_y = text_y + main_size + 20 if show_text else 20
-                            
-                            apply_text_effect(
-                                draw, 
-                                (wish_x, wish_y), 
-                                wish_text, 
-                                font_wish,
-                                effect_settings,
-                                texture_img=texture_image
-                            )
-                        
-                        if show_date:
-                            font_date = font.font_variant(size=date_size)
-                            
-                            if date_format == "8 July 2025":
-                                date_text = format_date("%d %B %Y", show_day)
-                            elif date_format == "28 January 2025":
-                                date_text = format_date("%d %B %Y", show_day)
-                            elif date_format == "07/08/2025":
-                                date_text = format_date("%m/%d/%Y", show_day)
-                            else:
-                                date_text = format_date("%Y-%m-%d", show_day)
-                                
-                            date_width, date_height = get_text_size(draw, date_text, font_date)
-                            
-                            if date_width > img.width - 40:
-                                font_date = adjust_font_size_to_fit(draw, date_text, img.width - 40, img.height//3, date_size)
-                                date_width, date_height = get_text_size(draw, date_text, font_date)
-                            
-                            date_x = (img.width - date_width) // 2
-                            date_y = img.height - date_height - 20
-                            
-                            if show_day and "(" in date_text:
-                                day_part = date_text[date_text.index("("):]
-                                day_width, _ = get_text_size(draw, day_part, font_date)
-                                if date_x + day_width > img.width - 20:
-                                    date_x = img.width - day_width - 25
-                            
-                            apply_text_effect(
-                                draw, 
-                                (date_x, date_y), 
-                                date_text, 
-                                font_date,
-                                effect_settings,
-                                texture_img=texture_image
-                            )
-                        
-                        if use_watermark and watermark_image:
-                            watermark = watermark_image.copy()
-                            
-                            if watermark_opacity < 1.0:
-                                alpha = watermark.split()[3]
-                                alpha = ImageEnhance.Brightness(alpha).enhance(watermark_opacity)
-                                watermark.putalpha(alpha)
-                            
-                            watermark.thumbnail((img.width//4, img.height//4))
-                            pos = get_watermark_position(img, watermark)
-                            img.paste(watermark, pos, watermark)
-                        
-                        if use_coffee_pet and selected_pet:
-                            pet_path = os.path.join("assets/pets", selected_pet)
-                            if os.path.exists(pet_path):
-                                pet_img = Image.open(pet_path).convert("RGBA")
-                                pet_img = pet_img.resize(
-                                    (int(img.width * pet_size), 
-                                    int(img.height * pet_size * (pet_img.height/pet_img.width))),
-                                    Image.LANCZOS
-                                )
-                                x = img.width - pet_img.width - 20
-                                y = img.height - pet_img.height - 20
-                                img.paste(pet_img, (x, y), pet_img)
-                        
-                        img = enhance_image_quality(img)
-                        img = upscale_text_elements(img, scale_factor=2)
-                        
-                        processed_images.append((generate_filename(), img))
-                
-                except Exception as e:
-                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
-                    continue
+                        st.error(f"Error processing {name}: {error}")
+                    finished[index] = outputs if error is None else []
+                    while next_index in finished:
+                        for filename, data, preview in finished.pop(next_index):
+                            with stage("zip"):
+                                filename = zip_export.add(filename, data)
+                            generated_images.add(filename, data, preview)
+                        next_index += 1
+                    batch_profile.add(name, stats.get('timings', []) + take_events(), stats.get('cprofile'))
+                    progress_bar.progress(done / len(uploads), text=f"Processed {done}/{len(uploads)}: {name}")
+                zip_export.close()
+                live_preview.empty()
+                st.session_state.batch_profile = batch_profile
 
-            st.session_state.generated_images = processed_images + variant_images
+                st.session_state.generated_images = generated_images
+                st.session_state.zip_export = zip_export
             
-            if st.session_state.generated_images:
-                st.success(f"Successfully processed {len(st.session_state.generated_images)} images!")
-            else:
-                st.warning("No images were processed successfully.")
+                if st.session_state.generated_images:
+                    st.success(f"Successfully processed {len(st.session_state.generated_images)} images!")
+                    st.caption(f"Text sprite cache hit rate: {text_sprite_hit_rate(batch_stats):.0%}")
+                    if deterministic:
+                        st.caption(f"Render cache hit rate: {render_cache_hit_rate(batch_stats):.0%}")
+                else:
+                    st.warning("No images were processed successfully.")
     else:
         st.warning("Please upload at least one image.")
 
+if st.session_state.batch_profile:
+    batch_profile = st.session_state.batch_profile
+    with st.expander("⏱️ Timing Report"):
+        st.table([{
+            'Stage': row['stage'],
+            'Images': row['images'],
+            'Total (s)': round(row['total_s'], 2),
+            'Mean (ms)': round(row['mean_ms'], 1),
+            'p95 (ms)': round(row['p95_ms'], 1)
+        } for row in batch_profile.summary()])
+        
+        st.markdown("**Slowest images**")
+        for name, seconds in batch_profile.slowest():
+            st.text(f"{seconds * 1000:8.0f} ms  {name}")
+        
+        export_cols = st.columns(2)
+        with export_cols[0]:
+            st.download_button("⬇️ Timings (JSON)", json.dumps(batch_profile.to_json(), indent=2),
+                               file_name="timings.json", mime="application/json")
+        with export_cols[1]:
+            st.download_button("⬇️ Chrome Trace", json.dumps(batch_profile.to_chrome_trace()),
+                               file_name="trace.json", mime="application/json",
+                               help="Open in chrome://tracing or ui.perfetto.dev")
+        
+        if batch_profile.has_cprofile:
+            st.markdown("**cProfile (top 30 by cumulative time)**")
+            st.code(batch_profile.cprofile_report())
+
 if st.session_state.generated_images:
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip_file:
-        for filename, img in st.session_state.generated_images:
-            try:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img_bytes = io.BytesIO()
-                img.save(img_bytes, format='JPEG', quality=95)
-                zip_file.writestr(filename, img_bytes.getvalue())
-            except Exception as e:
-                st.error(f"Error adding {filename} to zip: {str(e)}")
-                continue
-    
+    # Deferred: a file object would be read into memory on every rerun,
+    # a callable only when the button is clicked
     st.download_button(
         label="⬇️ Download All Photos",
-        data=zip_buffer.getvalue(),
+        data=st.session_state.zip_export.read,
         file_name="generated_photos.zip",
         mime="application/zip"
     )
@@ -737,31 +517,39 @@ if st.session_state.generated_images:
         </div>
     """, unsafe_allow_html=True)
     
-    cols_per_row = 3
-    rows = (len(st.session_state.generated_images) // cols_per_row) + 1
-    
-    for row in range(rows):
-        cols = st.columns(cols_per_row)
-        for col in range(cols_per_row):
-            idx = row * cols_per_row + col
-            if idx < len(st.session_state.generated_images):
-                filename, img = st.session_state.generated_images[idx]
+    # Only one page of thumbnails is sent per rerun, and full-size bytes
+    # only for the image whose download was asked for
+    store = st.session_state.generated_images
+    pages = (len(store) + PAGE_SIZE - 1) // PAGE_SIZE
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, key="preview_page")
+    start = (page - 1) * PAGE_SIZE
+    
+    def select_download(idx):
+        st.session_state.download_index = idx
+    
+    for row_start in range(start, min(start + PAGE_SIZE, len(store)), COLS_PER_ROW):
+        cols = st.columns(COLS_PER_ROW)
+        for col in range(COLS_PER_ROW):
+            idx = row_start + col
+            if idx < min(start + PAGE_SIZE, len(store)):
+                filename = store.filename(idx)
                 with cols[col]:
                     try:
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        img_bytes = io.BytesIO()
-                        img.save(img_bytes, format='JPEG', quality=95)
-                        img_bytes.seek(0)
-                        st.image(img_bytes, use_column_width=True)
+                        st.image(store.preview(idx), use_column_width=True)
                         st.caption(filename)
                         
-                        st.download_button(
-                            label="⬇️ Download",
-                            data=img_bytes.getvalue(),
-                            file_name=filename,
-                            mime="image/jpeg",
-                            key=f"download_{idx}"
-                        )
+                        if st.session_state.download_index == idx:
+                            st.download_button(
+                                label="💾 Save Full Size",
+                                data=store.data(idx),
+                                file_name=filename.replace("/", "_"),
+                                mime=output_mime_type(filename),
+                                key=f"download_{idx}"
+                            )
+                        else:
+                            st.button("⬇️ Download", key=f"prepare_{idx}",
+                                      on_click=select_download, args=(idx,))
                     except Exception as e:
                         st.error(f"Error displaying {filename}: {str(e)}")
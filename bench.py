@@ -0,0 +1,291 @@
+"""Benchmarks for the rendering pipeline, offline and without Streamlit.
+
+    python -m bench [--sizes 1,4,12,24,48] [--repeat 5] [--only text]
+                    [--save-baseline [PATH] | --compare [PATH]]
+
+Synthetic photos of each size (in megapixels, 3:4 portrait) are encoded as
+JPEG and run through every pipeline stage on its own (decode, smart_crop,
+enhance, faces (also on a real portrait), each text effect, overlay,
+watermark, upscale, each output encoder, ZIP),
+then through the whole batch path. Text and overlays use the real fonts and
+assets/overlays. Each stage reports p50/p95 latency and throughput; peak
+RSS is the process high-water mark after that stage.
+
+Stages run on the image the pipeline would see: decoded at --working-width
+(default: the app's) and drawn at output size, so only decode and crop
+scale with the source. Text, overlay and watermark stages are timed warm
+(sprites cached, as in a batch) and as *_cold with the sprite caches
+emptied before every run, which times rasterizing and resizing. Pass --working-width 0 to keep full resolution.
+A stage is a regression in --compare when its p50 is more than
+--tolerance slower than the baseline. Without a PATH both use the
+committed bench_baseline.json.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from render import (DEFAULT_SETTINGS, list_files, decode_upload, smart_crop, enhance_image_quality,
+                    apply_text_effect, apply_overlay, get_watermark_position, upscale_text_elements,
+                    get_random_font, font_at_size)
+from engine import iter_batch
+from export import encode_jpeg, encode_image, encoder_options, ZipExporter
+from fonts import get_font_registry
+from faces import detect_faces, get_cascade
+from sprites import get_thumbnail_sprite, get_sprite_cache, get_text_sprite_cache
+
+DEFAULT_SIZES = [1, 4, 12, 24, 48]
+BASELINE_PATH = "bench_baseline.json"
+PORTRAIT_PATH = os.path.join("tests", "data", "astronaut.jpg")
+TEXT_EFFECTS = ["white_only", "white_black_outline", "full_random", "texture"]
+# Output encoder settings benchmarked on the finished canvas; "encode" is the default
+ENCODERS = {
+    "encode": {},
+    "encode_optimized": {'jpeg_optimize': True, 'jpeg_progressive': True},
+    "encode_webp": {'output_format': "webp", 'output_quality': 85},
+    "encode_max_1mb": {'max_kb': 1024}
+}
+
+def synthetic_photo(megapixels, seed=0):
+    """Portrait RGB image of about megapixels with gradients and noise.
+
+    Smooth regions plus grain keep the JPEG size and decode cost close to a
+    real phone photo; flat or pure-noise images encode very differently.
+    """
+    height = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    width = height * 3 // 4
+    rng = np.random.default_rng(seed)
+    ys = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    xs = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    base = np.stack([
+        160 * ys + 60 * xs,
+        120 + 80 * np.sin(6 * xs + 3 * ys),
+        200 - 140 * ys * xs
+    ], axis=-1)
+    # Grain at a quarter resolution, upsampled, is much cheaper at 48 MP
+    grain = rng.normal(0, 12, ((height + 3) // 4, (width + 3) // 4, 3)).astype(np.float32)
+    grain = grain.repeat(4, axis=0).repeat(4, axis=1)[:height, :width]
+    return Image.fromarray(np.clip(base + grain, 0, 255).astype(np.uint8), "RGB")
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, int(np.ceil(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def measure(fn, setup=None, repeat=5, images=1):
+    """Time fn(*setup()) repeat times after one untimed warm-up run.
+
+    setup runs outside the timed region (e.g. to copy the canvas a stage
+    draws on). images is how many images one call processes, for
+    throughput.
+    """
+    def run():
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        return time.perf_counter() - start
+
+    run()
+    times = sorted(run() for _ in range(repeat))
+    return {
+        'p50_ms': percentile(times, 50) * 1000,
+        'p95_ms': percentile(times, 95) * 1000,
+        'images_per_s': images * repeat / sum(times),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def cold(setup):
+    """setup that first empties the sprite caches, so the run rebuilds every sprite"""
+    def run():
+        get_sprite_cache().clear()
+        get_text_sprite_cache().clear()
+        return setup()
+    return run
+
+def first_overlay():
+    root = os.path.join("assets", "overlays")
+    for theme in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        files = sorted(list_files(os.path.join(root, theme), [".png"]))
+        if files:
+            return os.path.join(root, theme, files[0])
+    return None
+
+def stage_benchmarks(megapixels, working_width):
+    """Yield (stage, fn, setup) for each pipeline stage on one synthetic photo"""
+    photo = synthetic_photo(megapixels)
+    data = encode_jpeg(photo)
+    settings = DEFAULT_SETTINGS
+    scale = settings['output_scale']
+
+    yield "decode", lambda: decode_upload(data, working_width), None
+    yield "smart_crop", lambda: smart_crop(photo), None
+
+    work = decode_upload(data, working_width)
+    yield "enhance", lambda: enhance_image_quality(work), None
+    get_cascade()
+    enhanced = enhance_image_quality(work)
+    yield "faces", lambda: detect_faces(enhanced), None
+    # A photo with a face keeps more windows alive through the cascade
+    with open(PORTRAIT_PATH, "rb") as f:
+        portrait = enhance_image_quality(decode_upload(f.read())).resize(enhanced.size, Image.LANCZOS)
+    yield "faces_portrait", lambda: detect_faces(portrait), None
+    yield "upscale", lambda: upscale_text_elements(work, scale_factor=scale), None
+
+    canvas = upscale_text_elements(enhance_image_quality(work), scale_factor=scale)
+    copy_canvas = lambda: (canvas.copy(),)
+    margin = 20 * scale
+
+    # Same font every run so results are comparable
+    font = font_at_size(get_random_font(random.Random(0)), settings['main_size'] * scale)
+    text = settings['greeting_type']
+    for effect in TEXT_EFFECTS:
+        effect_settings = {
+            'type': "white_black_outline" if effect == "texture" else effect,
+            'use_texture': effect == "texture",
+            'outline_width': settings['outline_width'] * scale
+        }
+        texture = photo if effect == "texture" else None
+        draw_text = lambda img, effect_settings=effect_settings, texture=texture: apply_text_effect(
+            img, (margin, margin), text, font, dict(effect_settings), texture)
+        yield f"text_{effect}", draw_text, copy_canvas
+        yield f"text_{effect}_cold", draw_text, cold(copy_canvas)
+
+    overlay_path = first_overlay()
+    if overlay_path is not None:
+        overlay = lambda img: apply_overlay(img, overlay_path, settings['overlay_size'], margin)
+        yield "overlay", overlay, copy_canvas
+        yield "overlay_cold", overlay, cold(copy_canvas)
+
+        # Any RGBA asset will do as a stand-in watermark
+        watermark_image = Image.open(overlay_path).convert("RGBA")
+
+        def watermark(img):
+            sprite = get_thumbnail_sprite(watermark_image, (img.width // 4, img.height // 4), 0.8)
+            img.paste(sprite, get_watermark_position(img, sprite, margin), sprite)
+        yield "watermark", watermark, copy_canvas
+        yield "watermark_cold", watermark, cold(copy_canvas)
+
+    for name, encoder_settings in ENCODERS.items():
+        options = encoder_options(dict(settings, **encoder_settings))
+        yield name, lambda options=options: encode_image(canvas, options), None
+
+    encoded = encode_jpeg(canvas)
+    exporter = ZipExporter()
+    try:
+        yield "zip", lambda: exporter.add("bench.jpg", encoded), None
+    finally:
+        exporter.discard()
+
+def batch_benchmark(megapixels, working_width, images, workers):
+    """Whole path, decode through JPEG encode, for a batch of distinct photos"""
+    uploads = [(f"bench_{i}.jpg", encode_jpeg(synthetic_photo(megapixels, seed=i))) for i in range(images)]
+    # seed=None renders every run instead of replaying the render cache
+    settings = dict(DEFAULT_SETTINGS, working_width=working_width, show_date=True, seed=None)
+
+    def run():
+        for _, name, _, error, _ in iter_batch(iter(uploads), settings, workers):
+            if error is not None:
+                raise RuntimeError(f"{name}: {error}")
+    return run
+
+def report(key, results):
+    result = results[key]
+    rss = f"{result['peak_rss_mb']:8.0f}" if result['peak_rss_mb'] is not None else f"{'n/a':>8s}"
+    print(f"{key:32s} {result['p50_ms']:9.1f} {result['p95_ms']:9.1f} {result['images_per_s']:8.1f} {rss}", flush=True)
+
+def compare(results, baseline, tolerance):
+    """Print p50 change per stage against baseline; return the regressed keys"""
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get('results', {}).get(key)
+        if before is None:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:32s} {before['p50_ms']:9.1f} -> {result['p50_ms']:9.1f} ms  {change:+6.0%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the rendering pipeline.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma-separated photo sizes in megapixels")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage")
+    parser.add_argument("--only", help="run only stages whose name contains this")
+    parser.add_argument("--working-width", type=int, default=DEFAULT_SETTINGS['working_width'],
+                        help="decode width; 0 keeps full resolution")
+    parser.add_argument("--batch-images", type=int, default=8, help="photos per batch run (0 skips it)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the batch run")
+    parser.add_argument("--save-baseline", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help=f"write results to a baseline JSON (default: {BASELINE_PATH})")
+    parser.add_argument("--compare", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help=f"compare against a baseline JSON (default: {BASELINE_PATH})")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="p50 slowdown that counts as a regression (default 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    sizes = [float(s) for s in args.sizes.split(",") if s]
+    working_width = args.working_width or None
+    get_font_registry()
+
+    results = {}
+    print(f"{'stage':32s} {'p50 ms':>9s} {'p95 ms':>9s} {'img/s':>8s} {'peak MB':>8s}")
+    for megapixels in sizes:
+        for stage, fn, setup in stage_benchmarks(megapixels, working_width):
+            if args.only and args.only not in stage:
+                continue
+            results[f"{stage}@{megapixels:g}MP"] = measure(fn, setup, args.repeat)
+            report(f"{stage}@{megapixels:g}MP", results)
+        if args.batch_images and (not args.only or args.only in "batch"):
+            run = batch_benchmark(megapixels, working_width, args.batch_images, args.workers)
+            # Each run is a whole batch, so fewer repeats are enough
+            results[f"batch@{megapixels:g}MP"] = measure(run, repeat=max(1, args.repeat // 2),
+                                                         images=args.batch_images)
+            report(f"batch@{megapixels:g}MP", results)
+
+    status = 0
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\nAgainst {args.compare} (p50):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed more than {args.tolerance:.0%}")
+            status = 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'working_width': working_width,
+                'repeat': args.repeat,
+                'results': results
+            }, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
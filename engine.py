@@ -0,0 +1,302 @@
+import os
+import queue
+import signal
+import logging
+import cProfile
+import threading
+import multiprocessing
+
+from render import decode_source, upload_rng, render_decoded, restamp_filename
+from export import encode_image, encoder_options, encode_preview
+from fonts import get_font_registry
+from sprites import get_text_sprite_cache
+from faces import get_cascade
+from timings import take_events, stage, merge_cprofile
+from rendercache import get_render_cache, image_digest, settings_fingerprint
+from pipeline import run_stages
+
+# Threads per worker process for the stages around rendering. Pillow drops
+# the GIL while decoding, resampling and encoding, so these overlap with the
+# render thread of the same process.
+DECODE_THREADS = 2
+ENCODE_THREADS = 2
+# Images allowed to wait between two stages of one worker. Together with
+# the threads this caps the full-resolution frames a worker holds at once
+# (about 2 * STAGE_QUEUE + DECODE_THREADS + 1 + ENCODE_THREADS) however
+# large the batch is.
+STAGE_QUEUE = 2
+
+def default_workers():
+    return os.cpu_count() or 1
+
+class _Batch:
+    """What every job of one iter_batch call renders with.
+
+    Jobs carry it instead of reading module globals, since with workers=1
+    several batches (one per app session) run as threads of one process.
+    Worker processes get it once when they start instead of it being
+    pickled again with each task (settings carry the watermark and
+    texture images).
+    """
+
+    def __init__(self, settings, preview_size=None, profile=False, fingerprint=None):
+        self.settings = settings
+        self.preview_size = preview_size
+        self.profile = profile
+        self.fingerprint = fingerprint
+
+class _Job:
+    """One upload on its way through the decode, render and encode stages"""
+
+    def __init__(self, batch, index, name, data):
+        self.batch = batch
+        self.index = index
+        self.name = name
+        self.data = data
+        self.digest = None
+        self.cache_key = None
+        self.cached = None
+        self.image = None
+        self.frames = []
+        self.outputs = []
+        self.error = None
+        self.stats = {
+            'text_sprite_hits': 0,
+            'text_sprite_misses': 0,
+            'render_cache_hits': 0,
+            'render_cache_misses': 0
+        }
+        self.events = []
+        self.profiles = []
+
+    def result(self):
+        stats = dict(self.stats, timings=self.events)
+        if self.profiles:
+            stats['cprofile'] = merge_cprofile(self.profiles)
+        return self.index, self.name, self.outputs, self.error, stats
+
+def _job_stage(fn):
+    """Run fn(job) unless the job already failed, recording its timings,
+    cProfile data and any exception on the job"""
+    def run(job):
+        if job.error is not None:
+            return job
+        take_events()
+        profiler = cProfile.Profile() if job.batch.profile else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            fn(job)
+        except Exception as e:
+            logging.exception(f"Error processing {job.name}")
+            job.error = str(e)
+            job.image, job.frames, job.outputs = None, [], []
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.create_stats()
+                job.profiles.append(profiler.stats)
+            job.events += take_events()
+        return job
+    return run
+
+@_job_stage
+def _decode(job):
+    if job.batch.settings.get('seed') is not None:
+        job.digest = image_digest(job.data)
+    if job.batch.fingerprint is not None:
+        cache = get_render_cache()
+        job.cache_key = cache.key(job.digest, job.batch.fingerprint)
+        job.cached = cache.get(job.cache_key)
+    if job.cached is None:
+        job.image = decode_source(job.data, job.batch.settings)
+    job.data = None
+
+@_job_stage
+def _render(job):
+    # The only stage that makes random choices, all from the job's own
+    # generator, so renders are repeatable whatever runs alongside
+    rng = upload_rng(None, job.batch.settings, job.digest)
+    if job.cached is not None:
+        # Filenames are timestamps, so they get a fresh one
+        job.outputs = [(_group(job, restamp_filename(filename, rng)), data, preview)
+                       for filename, data, preview in job.cached]
+        job.stats['render_cache_hits'] = 1
+        return
+    text_cache = get_text_sprite_cache()
+    hits, misses = text_cache.hits, text_cache.misses
+    job.frames = render_decoded(job.image, job.batch.settings, rng)
+    job.image = None
+    job.stats['text_sprite_hits'] = text_cache.hits - hits
+    job.stats['text_sprite_misses'] = text_cache.misses - misses
+
+@_job_stage
+def _encode(job):
+    # Encode in the worker so each image is compressed exactly once and
+    # only encoded bytes travel back to the parent process
+    if job.cached is not None:
+        return
+    options = encoder_options(job.batch.settings)
+    preview_size = job.batch.preview_size
+    with stage("encode"):
+        for filename, img in job.frames:
+            preview = encode_preview(img, preview_size) if preview_size else None
+            job.outputs.append((filename, encode_image(img, options), preview))
+    job.frames = []
+    if job.cache_key is not None:
+        try:
+            get_render_cache().put(job.cache_key, job.outputs)
+        except Exception as e:
+            # The outputs are fine; only the cache entry is lost
+            logging.warning(f"Could not cache {job.name}: {str(e)}")
+        job.stats['render_cache_misses'] = 1
+    job.outputs = [(_group(job, filename), data, preview) for filename, data, preview in job.outputs]
+
+def _group(job, filename):
+    """With renditions, outputs go in a folder named after the upload"""
+    if not job.batch.settings.get('renditions'):
+        return filename
+    return f"{os.path.splitext(os.path.basename(job.name))[0]}/{filename}"
+
+def _run_jobs(jobs):
+    """Yield results for an iterable of _Job through this process's stages"""
+    stages = [(_decode, DECODE_THREADS), (_render, 1), (_encode, ENCODE_THREADS)]
+    for job in run_stages(jobs, stages, STAGE_QUEUE):
+        yield job.result()
+
+def _worker_main(tasks, results, settings, preview_size, profile, fingerprint):
+    """Worker process: pull (index, name, data) from tasks until None"""
+    # Ctrl+C reaches the whole process group; the parent decides whether
+    # to stop, and terminates the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_font_registry()
+    batch = _Batch(settings, preview_size, profile, fingerprint)
+    jobs = (_Job(batch, *task) for task in iter(tasks.get, None))
+    for result in _run_jobs(jobs):
+        results.put(result)
+
+def merge_stats(total, stats):
+    """Add one image's stats into the running batch totals.
+
+    Besides counters, an image's stats hold 'timings', its stage events
+    (see timings.BatchProfile), and with profile set 'cprofile', its raw
+    cProfile stats.
+    """
+    for key, value in stats.items():
+        # timings and cprofile are per-image data for a BatchProfile, not counters
+        if isinstance(value, (int, float)):
+            total[key] = total.get(key, 0) + value
+    return total
+
+def text_sprite_hit_rate(stats):
+    lookups = stats.get('text_sprite_hits', 0) + stats.get('text_sprite_misses', 0)
+    return stats.get('text_sprite_hits', 0) / lookups if lookups else 0.0
+
+def render_cache_hit_rate(stats):
+    lookups = stats.get('render_cache_hits', 0) + stats.get('render_cache_misses', 0)
+    return stats.get('render_cache_hits', 0) / lookups if lookups else 0.0
+
+def iter_batch(uploads, settings, workers=None, preview_size=None, profile=False):
+    """Render an iterable of (name, bytes) uploads across worker processes.
+
+    Yields (index, name, outputs, error, stats) in completion order, where
+    outputs is a list of (filename, encoded bytes, preview or None), error
+    is None or the exception's message and stats is as in merge_stats.
+    uploads can be a lazy generator over a batch of any size.
+    """
+    workers = workers or default_workers()
+    # Scan fonts and parse the face cascade before forking so workers
+    # inherit them
+    get_font_registry()
+    if settings.get('avoid_faces', True):
+        get_cascade()
+    fingerprint = settings_fingerprint(settings, preview_size) if settings.get('seed') is not None else None
+
+    if workers == 1:
+        batch = _Batch(settings, preview_size, profile, fingerprint)
+        yield from _run_jobs(_Job(batch, index, name, data) for index, (name, data) in enumerate(uploads))
+        return
+
+    tasks = multiprocessing.Queue(maxsize=workers * 2)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_worker_main,
+                                         args=(tasks, results, settings, preview_size, profile, fingerprint),
+                                         daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Feed from a thread: put() blocks while the workers are busy, which is
+    # the backpressure on reading uploads
+    submitted = []
+    failures = []
+    feeding = threading.Event()
+    feeding.set()
+    stop = threading.Event()
+
+    def put(task):
+        while not stop.is_set():
+            try:
+                tasks.put(task, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed():
+        try:
+            for index, (name, data) in enumerate(uploads):
+                if not put((index, name, data)):
+                    return
+                submitted.append(index)
+        except BaseException as e:
+            failures.append(e)
+        finally:
+            for _ in processes:
+                put(None)
+            feeding.clear()
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    try:
+        received = 0
+        while feeding.is_set() or received < len(submitted):
+            try:
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError("A render worker process died")
+                continue
+            received += 1
+            yield result
+        feeder.join()
+        if failures:
+            raise failures[0]
+    finally:
+        # Also reached when the caller stops iterating early: drop whatever
+        # is still queued so neither this process nor the workers hang
+        stop.set()
+        tasks.cancel_join_thread()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def render_batch(uploads, settings, workers=None, progress=None, preview_size=None, profile=False):
+    """Render a list of (name, bytes) uploads, see iter_batch.
+
+    Returns one (name, outputs, error, stats) tuple per upload in upload
+    order.
+    progress, if given, is called as progress(done, total, name) in the
+    calling process whenever an image finishes.
+    """
+    total = len(uploads)
+    workers = max(1, min(workers or default_workers(), total))
+    results = [None] * total
+
+    for done, (index, name, outputs, error, stats) in enumerate(iter_batch(uploads, settings, workers, preview_size, profile), 1):
+        results[index] = (name, outputs, error, stats)
+        if progress:
+            progress(done, total, name)
+
+    return results
@@ -0,0 +1,167 @@
+from PIL import Image
+import io
+import os
+import logging
+import zipfile
+import weakref
+import tempfile
+
+from store import TEMP_PREFIX
+
+# format setting -> (Pillow format, file extension, MIME type)
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp")
+}
+# Lowest quality the max_kb search goes down to
+MIN_QUALITY = 30
+
+def encode_jpeg(img, quality=95):
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='JPEG', quality=quality)
+    return img_bytes.getvalue()
+
+def encoder_options(settings):
+    """The settings keys encode_image() uses, with the app's defaults"""
+    return {
+        'format': settings.get('output_format', "jpeg"),
+        'quality': settings.get('output_quality', 95),
+        'optimize': settings.get('jpeg_optimize', False),
+        'progressive': settings.get('jpeg_progressive', False),
+        'subsampling': settings.get('jpeg_subsampling'),
+        'max_kb': settings.get('max_kb')
+    }
+
+def output_extension(settings):
+    return FORMATS[settings.get('output_format', "jpeg")][1]
+
+def output_mime_type(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return next((mime for _, format_ext, mime in FORMATS.values() if format_ext == ext), "image/jpeg")
+
+def _save(img, options, quality):
+    params = {'quality': quality}
+    if options['format'] == "jpeg":
+        params['optimize'] = options['optimize']
+        params['progressive'] = options['progressive']
+        if options['subsampling']:
+            params['subsampling'] = options['subsampling']
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format=FORMATS[options['format']][0], **params)
+    return img_bytes.getvalue()
+
+def encode_image(img, options=None):
+    """Encode img as options (see encoder_options) say.
+
+    With options['max_kb'] set, quality is binary searched between
+    MIN_QUALITY and options['quality'] for the highest setting whose output
+    fits; every attempt encodes the same RGB image, so the pixels are
+    converted once. If even MIN_QUALITY is too big, that is returned.
+    """
+    options = options or encoder_options({})
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    quality = options['quality']
+    data = _save(img, options, quality)
+    if not options.get('max_kb') or len(data) <= options['max_kb'] * 1024:
+        return data
+
+    max_bytes = options['max_kb'] * 1024
+    if quality - 1 < MIN_QUALITY:
+        logging.warning(f"Could not fit image in {options['max_kb']} KB, "
+                        f"saved at quality {quality} ({len(data) // 1024} KB)")
+        return data
+    
+    best = None
+    low, high = MIN_QUALITY, quality - 1
+    while low <= high:
+        mid = (low + high) // 2
+        attempt = _save(img, options, mid)
+        if len(attempt) <= max_bytes:
+            best = attempt
+            low = mid + 1
+        else:
+            high = mid - 1
+    if best is None:
+        best = _save(img, options, MIN_QUALITY)
+        logging.warning(f"Could not fit image in {options['max_kb']} KB, "
+                        f"saved at quality {MIN_QUALITY} ({len(best) // 1024} KB)")
+    return best
+
+def encode_preview(img, size=(360, 480), quality=80):
+    """Small JPEG for the preview grid, fitting inside size"""
+    factor = max(1, min(img.width // size[0], img.height // size[1]))
+    preview = img.reduce(factor) if factor > 1 else img.copy()
+    preview.thumbnail(size, Image.LANCZOS)
+    return encode_jpeg(preview, quality=quality)
+
+def unique_path(output_dir, filename):
+    """generate_filename() only has one-second resolution, so avoid clobbering"""
+    path = os.path.join(output_dir, filename)
+    stem, ext = os.path.splitext(filename)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(output_dir, f"{stem}_{n}{ext}")
+        n += 1
+    return path
+
+def save_output(output_dir, filename, data):
+    """Write data into output_dir as filename (renamed if taken); returns the path"""
+    path = unique_path(output_dir, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def _remove_archive(file, path):
+    file.close()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ZipExporter:
+    """Writes already-encoded images into a ZIP on disk as they arrive.
+
+    JPEG data doesn't deflate, so entries are STORED. The archive lives in a
+    temp file rather than memory; read() loads it only when asked. The file
+    is removed by discard() or once the exporter is garbage collected.
+    """
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=".zip", dir=directory)
+        self._file = os.fdopen(fd, "w+b")
+        self._cleanup = weakref.finalize(self, _remove_archive, self._file, self.path)
+        self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_STORED)
+        self._names = set()
+        self.count = 0
+
+    def add(self, filename, data):
+        """Add data as filename, renaming it if that name is already taken"""
+        stem, ext = os.path.splitext(filename)
+        n = 1
+        while filename in self._names:
+            filename = f"{stem}_{n}{ext}"
+            n += 1
+        self._names.add(filename)
+        self._zip.writestr(filename, data)
+        self.count += 1
+        return filename
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._file.close()
+            self._zip = None
+
+    def read(self):
+        """The finished archive's bytes"""
+        self.close()
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def discard(self):
+        self.close()
+        self._cleanup()
@@ -0,0 +1,279 @@
+"""Font pool for the renderer, backed by a persistent font index.
+
+    python -m fonts [--folder assets/fonts] [--rebuild]
+
+builds or refreshes the index ahead of time and prints which fonts are
+left out of the pool; the app and generate.py refresh it on startup too,
+only reopening fonts whose file changed since the last run.
+"""
+from PIL import ImageFont
+import os
+import sys
+import json
+import random
+import string
+import logging
+import argparse
+import tempfile
+from collections import OrderedDict
+
+FONTS_DIR = "assets/fonts"
+FONT_EXTS = [".ttf", ".otf"]
+INDEX_NAME = ".font_index.json"
+# Bump when the index layout or how coverage is tested changes
+INDEX_VERSION = 2
+# Characters checked for coverage and measured; greetings, wishes and dates
+# only use these
+INDEX_CHARSET = " " + string.ascii_letters + string.digits + string.punctuation
+# Size advances and vertical metrics are recorded at
+METRICS_SIZE = 100
+# Code point no font maps, so it renders the font's .notdef glyph
+_UNMAPPED = "\U0010FFFD"
+# This many characters drawn with one identical bitmap are a placeholder
+# glyph, not real ones; l, I and | may legitimately match in sans fonts
+PLACEHOLDER_GROUP = 4
+
+def index_font(path, charset=INDEX_CHARSET):
+    """Index entry for one font file: loadability, coverage and metrics.
+
+    A character counts as missing when it renders nothing, the same bitmap
+    as .notdef (the "tofu" box) or the same bitmap as at least
+    PLACEHOLDER_GROUP - 1 other characters (demo fonts often draw every
+    digit and punctuation mark as one stand-in glyph), and the space when
+    it has almost no advance. Symbol, dingbat and barcode fonts map letters to pictures or
+    bars of similar shape; an "m" no wider than an "i" and an "o" as tall
+    as an "l" gives them away (caps-only fonts still have a wide M). Advances
+    and ascent/descent are in pixels at METRICS_SIZE.
+    """
+    stat = os.stat(path)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+        font = ImageFont.truetype(path, METRICS_SIZE)
+        notdef = font.getmask(_UNMAPPED)
+        notdef = (notdef.size, bytes(notdef))
+        missing = []
+        drawn_as = {}
+        for ch in charset.strip():
+            mask = font.getmask(ch)
+            bitmap = (mask.size, bytes(mask))
+            if mask.getbbox() is None or bitmap == notdef:
+                missing.append(ch)
+            else:
+                drawn_as.setdefault(bitmap, []).append(ch)
+        for chars in drawn_as.values():
+            if len(chars) >= PLACEHOLDER_GROUP:
+                missing += chars
+        missing.sort(key=charset.index)
+        if font.getlength(" ") < METRICS_SIZE * 0.1:
+            missing.insert(0, " ")
+
+        def ink(ch):
+            left, top, right, bottom = font.getbbox(ch)
+            return right - left, bottom - top
+        symbols = ink("m")[0] <= ink("i")[0] and ink("o")[1] >= 0.95 * ink("l")[1]
+        ascent, descent = font.getmetrics()
+        entry.update({
+            'loadable': True,
+            'symbols': symbols,
+            'missing': "".join(missing),
+            'ascent': ascent,
+            'descent': descent,
+            'advances': [round(font.getlength(ch), 1) for ch in charset]
+        })
+    except Exception as e:
+        entry.update({'loadable': False, 'error': str(e)})
+    return entry
+
+class FontIndex:
+    """Per-font loadability, glyph coverage and metrics, kept in a JSON file.
+
+    update() reindexes only fonts whose size or mtime changed (or all of
+    them when the charset or INDEX_VERSION differs) and drops deleted ones;
+    save() writes the file atomically. Keys are file names in the folder,
+    so the index can be shipped along with the fonts.
+    """
+
+    def __init__(self, folder=FONTS_DIR, path=None, charset=INDEX_CHARSET):
+        self.folder = folder
+        self.path = path or os.path.join(folder, INDEX_NAME)
+        self.charset = charset
+        self.fonts = {}
+        self.dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION and data.get('charset') == charset:
+                self.fonts = data['fonts']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Rebuilding unreadable font index {self.path}: {str(e)}")
+
+    def update(self, rebuild=False):
+        """Bring the index in line with the folder; returns how many fonts were (re)indexed"""
+        names = sorted(name for name in os.listdir(self.folder)
+                       if any(name.lower().endswith(ext) for ext in FONT_EXTS)) if os.path.isdir(self.folder) else []
+        indexed = 0
+        for name in names:
+            path = os.path.join(self.folder, name)
+            entry = self.fonts.get(name)
+            stat = os.stat(path)
+            if rebuild or entry is None or (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+                self.fonts[name] = index_font(path, self.charset)
+                indexed += 1
+        removed = set(self.fonts) - set(names)
+        for name in removed:
+            del self.fonts[name]
+        if indexed or removed:
+            self.dirty = True
+        return indexed
+
+    def save(self):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+            os.chmod(tmp_path, 0o644)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({'version': INDEX_VERSION, 'charset': self.charset, 'fonts': self.fonts},
+                          f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            # A read-only fonts folder only means indexing again next start
+            logging.warning(f"Could not write font index {self.path}: {str(e)}")
+
+    def covers(self, name, chars):
+        entry = self.fonts.get(name)
+        if not entry or not entry['loadable'] or entry['symbols']:
+            return False
+        return not set(entry['missing']) & set(chars)
+
+    def text_size(self, name, text, size):
+        """Approximate (width, height) of text at size from the cached metrics.
+
+        Width is the sum of advances (no kerning), height ascent + descent.
+        None if the font isn't indexed or text has characters outside the
+        charset.
+        """
+        entry = self.fonts.get(name)
+        if not entry or not entry['loadable']:
+            return None
+        advances = entry['advances']
+        try:
+            width = sum(advances[self.charset.index(ch)] for ch in text)
+        except ValueError:
+            return None
+        scale = size / METRICS_SIZE
+        return width * scale, (entry['ascent'] + entry['descent']) * scale
+
+class FontRegistry:
+    """Font pool from the font index, handing out cached FreeType faces.
+
+    Fonts that fail to load are left out of the pool instead of being
+    retried at render time, and choice() only picks fonts with glyphs for
+    every character the caller will draw. Loaded faces are kept in an LRU
+    keyed by (font_path, size), bounded by the summed size of the font
+    files backing them.
+    """
+
+    def __init__(self, folder=FONTS_DIR, max_cache_bytes=64 * 1024 * 1024, index=None):
+        self.folder = folder
+        self.max_cache_bytes = max_cache_bytes
+        self.fonts = []
+        self.rejected = []
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._compatible = {}
+        self.hits = 0
+        self.misses = 0
+        self.index = index or FontIndex(folder)
+        self._scan()
+
+    def _scan(self):
+        indexed = self.index.update()
+        if indexed:
+            logging.info(f"Indexed {indexed} fonts in {self.folder}")
+        if self.index.dirty:
+            self.index.save()
+        for name, entry in sorted(self.index.fonts.items()):
+            path = os.path.join(self.folder, name)
+            if entry['loadable']:
+                self.fonts.append(path)
+            else:
+                logging.warning(f"Skipping unloadable font {name}: {entry['error']}")
+                self.rejected.append(path)
+
+    def compatible(self, chars=""):
+        """Pool paths whose fonts have glyphs for all of chars"""
+        chars = "".join(sorted(set(chars)))
+        if chars not in self._compatible:
+            fonts = [path for path in self.fonts if self.index.covers(os.path.basename(path), chars)]
+            if not fonts and self.fonts:
+                logging.warning(f"No font covers {chars!r}, picking from all fonts")
+                fonts = self.fonts
+            self._compatible[chars] = fonts
+        return self._compatible[chars]
+
+    def text_size(self, font_path, text, size):
+        """Approximate text size from the index without opening the font, see FontIndex"""
+        return self.index.text_size(os.path.basename(font_path), text, size)
+
+    def get(self, font_path, size):
+        """Return the FreeTypeFont for font_path at size, loading it at most once"""
+        key = (font_path, size)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        font = ImageFont.truetype(font_path, size)
+        cost = os.path.getsize(font_path)
+        self._cache[key] = (font, cost)
+        self._cache_bytes += cost
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, (_, evicted_cost) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted_cost
+        return font
+
+    def choice(self, rng=None, chars=""):
+        """Pick a font path covering chars with rng (a random.Random), or the global random module"""
+        fonts = self.compatible(chars)
+        if not fonts:
+            return None
+        return (rng or random).choice(fonts)
+
+    def picker(self, seed, chars=""):
+        """Return a function that picks font paths from its own seeded stream"""
+        rng = random.Random(seed)
+        return lambda: self.choice(rng, chars)
+
+_registry = None
+
+def get_font_registry():
+    global _registry
+    if _registry is None:
+        _registry = FontRegistry()
+    return _registry
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m fonts", description="Build or refresh the font index.")
+    parser.add_argument("--folder", default=FONTS_DIR, help="fonts folder")
+    parser.add_argument("--rebuild", action="store_true", help="reindex every font, not just changed ones")
+    args = parser.parse_args(argv)
+
+    index = FontIndex(args.folder)
+    indexed = index.update(rebuild=args.rebuild)
+    index.save()
+    print(f"Indexed {indexed} of {len(index.fonts)} fonts into {index.path}")
+    for name, entry in sorted(index.fonts.items()):
+        if not entry['loadable']:
+            print(f"  unloadable  {name}: {entry['error']}")
+        elif entry['symbols']:
+            print(f"  symbols     {name}")
+        elif set(entry['missing']) & set(string.ascii_letters):
+            print(f"  no letters  {name}: missing {entry['missing']!r}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Headless batch generation without Streamlit.
+
+    python -m generate INPUT_DIR OUTPUT_DIR --settings settings.toml [--workers N]
+                       [--watch] [--manifest PATH] [--retry-failed]
+                       [--timings timings.json] [--trace trace.json] [--profile out.prof]
+
+The settings file (TOML or JSON) uses the same keys as the settings dict the
+app builds, e.g. greeting_type, show_date, text_effect ("white_only",
+"white_black_outline" or "full_random"), overlay_theme/overlay_files,
+output_format ("jpeg" or "webp"), output_quality, jpeg_optimize,
+jpeg_progressive, jpeg_subsampling ("4:4:4", "4:2:0", ...) and max_kb
+(largest file size; quality is lowered per image until it fits).
+renditions lists versions to make of every photo ("story" 9:16, "square"
+1:1, "portrait" 3:4), written to a subfolder per photo.
+Images are given as paths: watermark_path and texture_path. Missing keys
+fall back to the app's sidebar defaults, including seed = 0: renders are
+repeatable and reused from the render cache (set "seed" to another number
+for a different layout; a JSON null renders randomly, uncached).
+
+Photos are read from INPUT_DIR one at a time and every output is written
+to OUTPUT_DIR as soon as it is rendered, so memory use does not grow with
+the number of photos. Each finished photo is recorded (path, size, mtime)
+in OUTPUT_DIR/.ingest_manifest.jsonl, and photos already in it are
+skipped: rerunning an interrupted batch resumes it, and only new or
+changed photos are rendered. --watch keeps polling INPUT_DIR for new
+photos until interrupted with Ctrl+C.
+
+--timings writes per-stage timings (see timings.BatchProfile), --trace the
+same as a Chrome trace and --profile merged cProfile stats for pstats or
+snakeviz; --profile slows rendering down.
+"""
+from PIL import Image
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tomllib
+
+from render import DEFAULT_SETTINGS
+from engine import iter_batch, default_workers, merge_stats, text_sprite_hit_rate, render_cache_hit_rate
+from export import save_output
+from timings import BatchProfile, stage, take_events
+from ingest import Manifest, DirectoryIngest, MANIFEST_NAME
+
+def load_settings(path):
+    if path is None:
+        data = {}
+    elif path.lower().endswith(".toml"):
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(data)
+
+    watermark_path = settings.pop('watermark_path', None)
+    if watermark_path:
+        settings['watermark_image'] = Image.open(watermark_path).convert("RGBA")
+        settings['use_watermark'] = data.get('use_watermark', True)
+    texture_path = settings.pop('texture_path', None)
+    if texture_path:
+        settings['texture_image'] = Image.open(texture_path).convert("RGBA")
+    return settings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m generate", description="Batch-generate greeting photos.")
+    parser.add_argument("input_dir", help="folder of .jpg/.jpeg/.png photos")
+    parser.add_argument("output_dir", help="folder the generated photos are written to")
+    parser.add_argument("--settings", help="settings file (.toml or .json)")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="worker processes (default: CPU count)")
+    parser.add_argument("--watch", action="store_true", help="keep polling input_dir for new photos")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between scans with --watch")
+    parser.add_argument("--manifest", metavar="PATH",
+                        help=f"record of processed photos (default: output_dir/{MANIFEST_NAME})")
+    parser.add_argument("--retry-failed", action="store_true", help="render photos that failed last time again")
+    parser.add_argument("--timings", metavar="PATH", help="write per-stage timings as JSON")
+    parser.add_argument("--trace", metavar="PATH", help="write per-stage timings as a Chrome trace")
+    parser.add_argument("--profile", metavar="PATH", help="write cProfile stats of the rendering")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    settings = load_settings(args.settings)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output_dir, MANIFEST_NAME))
+    inputs = DirectoryIngest(args.input_dir, manifest, watch=args.watch, poll_interval=args.poll_interval,
+                             retry_failed=args.retry_failed)
+
+    start = time.time()
+    written = failed = 0
+    batch_stats = {}
+    # Per-image timings grow with the batch, so only keep them when asked for
+    batch_profile = BatchProfile() if args.timings or args.trace or args.profile or args.verbose else None
+    take_events()
+    try:
+        for index, name, outputs, error, stats in iter_batch(inputs, settings, args.workers,
+                                                             profile=bool(args.profile)):
+            merge_stats(batch_stats, stats)
+            paths = []
+            if error is None:
+                for filename, data, _ in outputs:
+                    with stage("zip"):
+                        paths.append(save_output(args.output_dir, filename, data))
+                    logging.info(f"{name} -> {paths[-1]}")
+                    written += 1
+            else:
+                logging.error(f"Error processing {name}: {error}")
+                failed += 1
+            inputs.done(name, paths, error)
+            events = stats.get('timings', []) + take_events()
+            if batch_profile is not None:
+                batch_profile.add(name, events, stats.get('cprofile'))
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume")
+    finally:
+        manifest.close()
+
+    print(f"Wrote {written} images to {args.output_dir} in {time.time() - start:.1f}s ({failed} failed, "
+          f"{inputs.skipped} already done)")
+    logging.info(f"Text sprite cache hit rate: {text_sprite_hit_rate(batch_stats):.0%}")
+    if settings.get('seed') is not None:
+        logging.info(f"Render cache hit rate: {render_cache_hit_rate(batch_stats):.0%}")
+    if batch_profile is None:
+        return 1 if failed else 0
+    if args.timings:
+        with open(args.timings, "w", encoding="utf-8") as f:
+            json.dump(batch_profile.to_json(), f, indent=2)
+    if args.trace:
+        with open(args.trace, "w", encoding="utf-8") as f:
+            json.dump(batch_profile.to_chrome_trace(), f)
+    if args.profile:
+        batch_profile.dump_cprofile(args.profile)
+    for row in batch_profile.summary():
+        logging.info(f"{row['stage']:10s} {row['total_s']:7.2f}s total, {row['mean_ms']:7.1f} ms mean, "
+                     f"{row['p95_ms']:7.1f} ms p95")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Lazy ingestion of photos from a server-side folder, with resume.
+
+A DirectoryIngest yields (name, bytes) for the photos in a folder one at a
+time, so it can be handed straight to engine.iter_batch. Photos that were
+already processed are skipped using a Manifest kept next to the outputs;
+callers call done() once an image's outputs are written, so an
+interrupted run picks up where it stopped. With watch set, the folder is
+polled for new photos until the caller stops iterating.
+"""
+import os
+import json
+import time
+import logging
+
+from render import list_files
+
+IMAGE_EXTS = [".jpg", ".jpeg", ".png"]
+MANIFEST_NAME = ".ingest_manifest.jsonl"
+
+class Manifest:
+    """Processed input files, as one JSON line per file appended to path.
+
+    A file counts as processed while its size and mtime are unchanged, so
+    replacing a photo with a new one of the same name renders it again.
+    Lines are appended and flushed as images finish; a half-written last
+    line from a crash is ignored on load. Only path, size, mtime and
+    whether it failed are kept in memory, a few hundred bytes per file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry['path']] = (entry['size'], entry['mtime_ns'], entry.get('error') is not None)
+                    except (ValueError, KeyError):
+                        logging.warning(f"Skipping unreadable line in {path}")
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_done(self, path, stat, retry_failed=False):
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+            return False
+        return not (retry_failed and entry[2])
+
+    def record(self, path, stat, outputs=(), error=None):
+        self._entries[path] = (stat.st_size, stat.st_mtime_ns, error is not None)
+        self._file.write(json.dumps({
+            'path': path,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'outputs': list(outputs),
+            'error': error
+        }) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class DirectoryIngest:
+    """Iterable of (name, bytes) for the unprocessed photos in input_dir.
+
+    Names are the file names inside input_dir. Files are read only when
+    the consumer asks for the next one, so at most the ones it is working
+    on are in memory. Call done(name, ...) for every name yielded once its
+    outputs are saved; until then it is not yielded again, and if the run
+    stops first it is picked up by the next one.
+
+    With watch set, the folder is scanned again every poll_interval
+    seconds once it is drained, and iteration only ends when the consumer
+    stops. Files modified in the last settle seconds are left for a later
+    scan since they may still be being copied in.
+    """
+
+    def __init__(self, input_dir, manifest, watch=False, poll_interval=2.0, settle=2.0, retry_failed=False):
+        self.input_dir = input_dir
+        self.manifest = manifest
+        self.watch = watch
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.retry_failed = retry_failed
+        # Files the last pending() or first scan left out because the
+        # manifest has them
+        self.skipped = 0
+        # name -> (path, stat) of files yielded but not done() yet
+        self._in_flight = {}
+
+    def _scan(self, count_skipped=False):
+        """Yield (name, path, stat) for files that still need processing"""
+        if count_skipped:
+            self.skipped = 0
+        now = time.time()
+        for name in sorted(list_files(self.input_dir, IMAGE_EXTS)):
+            if name in self._in_flight:
+                continue
+            path = os.path.abspath(os.path.join(self.input_dir, name))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if self.manifest.is_done(path, stat, self.retry_failed):
+                self.skipped += count_skipped
+                continue
+            if self.watch and now - stat.st_mtime < self.settle:
+                continue
+            yield name, path, stat
+
+    def pending(self):
+        """Number of files the next scan would yield, for progress bars"""
+        return sum(1 for _ in self._scan(count_skipped=True))
+
+    def __iter__(self):
+        first = True
+        while True:
+            found = False
+            for name, path, stat in self._scan(count_skipped=first):
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except OSError as e:
+                    logging.warning(f"Could not read {path}: {str(e)}")
+                    continue
+                found = True
+                self._in_flight[name] = (path, stat)
+                yield name, data
+            if not self.watch:
+                return
+            first = False
+            if not found:
+                time.sleep(self.poll_interval)
+
+    def done(self, name, outputs=(), error=None):
+        """Record a yielded file as processed, with its output paths"""
+        path, stat = self._in_flight[name]
+        # Recorded before it leaves _in_flight, so a scan running on the
+        # feeder thread meanwhile sees it as one or the other, never neither
+        self.manifest.record(path, stat, outputs, error)
+        del self._in_flight[name]
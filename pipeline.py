@@ -0,0 +1,95 @@
+import queue
+import threading
+
+_DONE = object()
+
+class _Failure:
+    """An exception raised inside a stage, carried to the consumer"""
+
+    def __init__(self, error):
+        self.error = error
+
+def run_stages(items, stages, queue_size=2):
+    """Push items through threaded stages connected by bounded queues.
+
+    stages is a list of (fn, threads): each stage runs fn(item) on that many
+    threads and hands the return value to the next stage. Yields the last
+    stage's results in completion order. No queue holds more than
+    queue_size items, so a slow stage blocks the ones feeding it instead of
+    letting work (and memory) pile up in between. items is only advanced
+    when the first queue has room, so it can be a lazy generator.
+
+    Stage functions should handle their own per-item errors; anything they
+    raise stops the pipeline and is re-raised here. Closing the generator
+    early stops all threads.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except BaseException as e:
+            put(queues[0], _Failure(e))
+        for _ in range(stages[0][1]):
+            put(queues[0], _DONE)
+
+    def work(index, fn, remaining):
+        source, target = queues[index], queues[index + 1]
+        while True:
+            item = get(source)
+            if item is _DONE:
+                break
+            if not isinstance(item, _Failure):
+                try:
+                    item = fn(item)
+                except BaseException as e:
+                    item = _Failure(e)
+            if not put(target, item):
+                return
+        # The last thread of a stage to finish tells every thread of the next
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            next_threads = stages[index + 1][1] if index + 1 < len(stages) else 1
+            for _ in range(next_threads):
+                put(target, _DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for index, (fn, count) in enumerate(stages):
+        remaining = [count, threading.Lock()]
+        threads += [threading.Thread(target=work, args=(index, fn, remaining), daemon=True)
+                    for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,851 @@
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+import os
+import io
+import math
+import random
+import datetime
+import numpy as np
+import logging
+
+from fonts import get_font_registry
+from faces import detect_faces
+from timings import stage, timed
+from rendercache import image_digest, image_seed
+from export import output_extension
+from sprites import get_sprite, get_thumbnail_sprite, load_asset, get_text_sprite, get_canvas_texture
+from layout import Slot, plan_layout, PLAN_SEEDS, ANYWHERE, ALIGNED, BOTTOM_CORNERS
+
+# Sidebar defaults, used by callers that don't go through the Streamlit UI
+DEFAULT_SETTINGS = {
+    'greeting_type': "Good Morning",
+    'generate_variants': False,
+    'show_text': True,
+    'main_size': 90,
+    'show_wish': True,
+    'wish_size': 60,
+    'show_date': False,
+    'show_day': False,
+    'date_size': 30,
+    'date_format': "8 July 2025",
+    'use_watermark': False,
+    'watermark_image': None,
+    'watermark_opacity': 1.0,
+    'use_overlay': False,
+    'overlay_files': [],
+    'overlay_theme': "",
+    'overlay_size': 0.5,
+    'use_coffee_pet': False,
+    'pet_size': 0.3,
+    'selected_pet': None,
+    'text_effect': "white_only",
+    'outline_width': 2,
+    'working_width': 1080,
+    'output_scale': 2,
+    'render_at_output_size': True,
+    'use_texture': False,
+    'texture_image': None,
+    'avoid_faces': True,
+    'seed': 0,
+    'output_format': "jpeg",
+    'output_quality': 95,
+    'jpeg_optimize': False,
+    'jpeg_progressive': False,
+    'jpeg_subsampling': None,
+    'max_kb': None,
+    'renditions': []
+}
+
+# Aspect ratios (width / height) that settings['renditions'] can ask for;
+# without renditions every output is a single 3:4 portrait
+RENDITIONS = {
+    "story": 9/16,
+    "square": 1/1,
+    "portrait": 3/4
+}
+
+# =================== UTILS ===================
+def list_files(folder, exts):
+    """List files in folder with given extensions"""
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+        return []
+    return [f for f in os.listdir(folder) 
+           if any(f.lower().endswith(ext.lower()) for ext in exts)]
+
+def crop_box(size, target_ratio=3/4):
+    """Centered box of size (w, h) with the target width/height ratio"""
+    w, h = size
+    if w/h > target_ratio:
+        new_w = int(h * target_ratio)
+        left = (w - new_w) // 2
+        return (left, 0, left + new_w, h)
+    else:
+        new_h = int(w / target_ratio)
+        top = (h - new_h) // 2
+        return (0, top, w, top + new_h)
+
+def smart_crop(img, target_ratio=3/4):
+    return img.crop(crop_box(img.size, target_ratio))
+
+def decode_upload(data, working_width=None, target_ratio=3/4):
+    """Decode upload bytes straight to the cropped working image (RGB).
+    
+    JPEGs are DCT-scaled while decoding (Image.draft) to the smallest size
+    that still covers working_width after cropping, then the crop and the
+    final downscale happen in one resize. Without working_width the photo
+    is only cropped, at full resolution.
+    """
+    with stage("decode"):
+        img = Image.open(io.BytesIO(data))
+        if img is None:
+            raise ValueError("Could not open image")
+        
+        box = crop_box(img.size, target_ratio)
+        crop_w = box[2] - box[0]
+        if working_width and crop_w > working_width:
+            scale = working_width / crop_w
+            img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            box = crop_box(img.size, target_ratio)
+        img.load()
+    
+    with stage("crop"):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+        if working_width and crop_w > working_width:
+            size = (working_width, round(crop_h * working_width / crop_w))
+            return img.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
+        return img.crop(box)
+
+def _narrowest_crop(size, ratios):
+    return min(crop_box(size, ratio)[2] - crop_box(size, ratio)[0] for ratio in ratios)
+
+def decode_for_renditions(data, working_width=None, ratios=(3/4,)):
+    """Decode upload bytes once for crops at several aspect ratios.
+    
+    Like decode_upload, but the photo stays uncropped (RGB): it is
+    DCT-scaled and resized so that the narrowest of the crops is
+    working_width wide, and crop_rendition() cuts each crop from it.
+    """
+    with stage("decode"):
+        img = Image.open(io.BytesIO(data))
+        crop_w = _narrowest_crop(img.size, ratios)
+        if working_width and crop_w > working_width:
+            scale = working_width / crop_w
+            img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img.load()
+    
+    with stage("crop"):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        crop_w = _narrowest_crop(img.size, ratios)
+        if working_width and crop_w > working_width:
+            scale = working_width / crop_w
+            size = (round(img.width * scale), round(img.height * scale))
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        return img
+
+def crop_rendition(img, faces, ratio, width=None):
+    """Crop of img at ratio resized to width (None keeps it), and faces moved into it"""
+    box = crop_box(img.size, ratio)
+    crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+    factor = 1
+    if width and crop_w != width:
+        factor = width / crop_w
+        crop = img.resize((width, round(crop_h * factor)), Image.LANCZOS, box=box, reducing_gap=3.0)
+    else:
+        crop = img.crop(box)
+    
+    moved = []
+    for left, top, right, bottom in faces:
+        left, right = (left - box[0]) * factor, (right - box[0]) * factor
+        top, bottom = (top - box[1]) * factor, (bottom - box[1]) * factor
+        if right > 0 and bottom > 0 and left < crop.width and top < crop.height:
+            moved.append((int(left), int(top), int(math.ceil(right)), int(math.ceil(bottom))))
+    return crop, moved
+
+def decode_source(data, settings):
+    """decode_upload, or decode_for_renditions when settings['renditions'] is set.
+    
+    The result is no more than settings['working_width'] pixels wide
+    (None keeps full resolution).
+    """
+    if settings.get('renditions'):
+        ratios = [RENDITIONS[name] for name in settings['renditions']]
+        return decode_for_renditions(data, settings.get('working_width'), ratios)
+    return decode_upload(data, settings.get('working_width'))
+
+def get_text_size(draw, text, font):
+    bbox = draw.textbbox((0, 0), text, font=font)
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+def ink_extent(draw, text, font):
+    """Width and height from the draw origin to the far edges of the ink.
+    
+    Glyphs start below (and sometimes right of) the origin, so this is the
+    box a line of text drawn at (x, y) actually covers, from (x, y).
+    """
+    bbox = draw.textbbox((0, 0), text, font=font)
+    return max(bbox[2], 1), max(bbox[3], 1)
+
+@timed("font")
+def get_random_font(rng=None, chars=""):
+    """Random font with glyphs for every character in chars (see required_chars)"""
+    registry = get_font_registry()
+    font_path = registry.choice(rng, chars)
+    if font_path is None:
+        return None  # Return None if no loadable fonts available
+    return registry.get(font_path, 80)
+
+@timed("font")
+def font_at_size(font, size):
+    """Same face as font at another size, served from the font registry"""
+    return get_font_registry().get(font.path, size)
+
+WISHES = {
+    "Good Morning": ["Rise and shine!", "Make today amazing!", "Morning blessings!", "New day, new blessings!"],
+    "Good Afternoon": ["Enjoy your day!", "Afternoon delights!", "Sunshine and smiles!", "Perfect day ahead!"],
+    "Good Evening": ["Beautiful sunset!", "Evening serenity!", "Twilight magic!", "Peaceful evening!"],
+    "Good Night": ["Sweet dreams!", "Sleep tight!", "Night night!", "Rest well!"]
+}
+
+# settings['date_format'] choices -> strftime format
+DATE_FORMATS = {
+    "8 July 2025": "%d %B %Y",
+    "28 January 2025": "%d %B %Y",
+    "07/08/2025": "%m/%d/%Y",
+    "2025-07-08": "%Y-%m-%d"
+}
+
+def get_random_wish(greeting_type, rng=None):
+    return (rng or random).choice(WISHES.get(greeting_type, ["Have a nice day!"]))
+
+def settings_date_text(settings):
+    return format_date(DATE_FORMATS.get(settings['date_format'], "%Y-%m-%d"), settings['show_day'])
+
+def required_chars(settings):
+    """Every character the settings can draw: greeting, any of its wishes and today's date"""
+    chars = ""
+    if settings['show_text']:
+        chars += settings['greeting_type']
+    if settings['show_wish']:
+        chars += "".join(WISHES.get(settings['greeting_type'], ["Have a nice day!"]))
+    if settings['show_date']:
+        chars += settings_date_text(settings)
+    return chars
+
+def get_random_color(rng=None):
+    rng = rng or random
+    return rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)
+
+@timed("text")
+def apply_text_effect(img, position, text, font, effect_settings, texture_img=None, rng=None):
+    x, y = position
+    effect_type = effect_settings['type']
+    
+    # For full random, we'll use the same color for all text in the image
+    if effect_type == 'full_random':
+        main_color = effect_settings.get('main_color', (255, 255, 255))
+        outline_color = effect_settings.get('outline_color', (0, 0, 0))
+    else:
+        main_color = effect_settings.get('main_color', (255, 255, 255))
+        outline_color = effect_settings.get('outline_color', (0, 0, 0))
+    
+    # Outlines are a single stroked rasterization, so the cost no longer
+    # grows with the square of the outline width. Each string is rasterized
+    # once per batch into a cached sprite and then only pasted.
+    outline_size = effect_settings.get('outline_width', 2)
+    
+    if effect_settings.get('use_texture', False) and texture_img:
+        if effect_type == "white_black_outline":
+            paste_textured_text(img, (x, y), text, font, texture_img, outline_size, outline_color)
+        else:
+            paste_textured_text(img, (x, y), text, font, texture_img)
+        return effect_settings
+    
+    if effect_type == "white_only":
+        paste_text(img, (x, y), text, font, main_color)
+    elif effect_type == "white_black_outline":
+        paste_text(img, (x, y), text, font, main_color, outline_size, outline_color)
+    elif effect_type == "full_random":
+        # 50% chance for white or white with black outline
+        if (rng or random).random() < 0.5:
+            paste_text(img, (x, y), text, font, main_color)
+        else:
+            paste_text(img, (x, y), text, font, main_color, outline_size, outline_color)
+    
+    return effect_settings
+
+def paste_text(img, position, text, font, fill, stroke_width=0, stroke_fill=None):
+    """Same result as ImageDraw.text at position, via the text sprite cache"""
+    sprite, (offset_x, offset_y) = get_text_sprite(text, font, fill, stroke_width, stroke_fill)
+    img.paste(sprite, (position[0] + offset_x, position[1] + offset_y), sprite)
+
+def paste_textured_text(img, position, text, font, texture_img, stroke_width=0, stroke_fill=None):
+    """Text filled with texture_img, optionally outlined.
+    
+    The texture is fitted to the whole canvas once per canvas size and
+    each string takes the patch under it, so texturing is a single masked
+    paste per string.
+    """
+    if stroke_width:
+        paste_text(img, position, text, font, stroke_fill, stroke_width, stroke_fill)
+    sprite, (offset_x, offset_y) = get_text_sprite(text, font, (255, 255, 255))
+    x, y = position[0] + offset_x, position[1] + offset_y
+    texture = get_canvas_texture(texture_img, img.size)
+    img.paste(texture.crop((x, y, x + sprite.width, y + sprite.height)), (x, y), sprite.getchannel("A"))
+
+def format_date(date_format="%d %B %Y", show_day=False):
+    today = datetime.datetime.now()
+    formatted_date = today.strftime(date_format)
+    
+    if show_day:
+        if today.hour >= 19:
+            next_day = today + datetime.timedelta(days=1)
+            day_name = next_day.strftime("%A")
+            formatted_date += f" (Advance {day_name})"
+        else:
+            day_name = today.strftime("%A")
+            formatted_date += f" ({day_name})"
+    
+    return formatted_date
+
+def overlay_sprite(image, overlay_path, size=0.5):
+    """Overlay resized to size, a fraction of image's width and height"""
+    return get_sprite(overlay_path, (int(image.width * size), int(image.height * size)))
+
+def visible_box(sprite):
+    """Bounding box of the non-transparent pixels of an RGBA sprite"""
+    return sprite.getbbox() or (0, 0) + sprite.size
+
+def overlay_slot(name, image, overlay, margin=20):
+    """Slot for the visible part of an overlay sprite, anywhere on image.
+    
+    Overlays often have wide transparent borders; planning with only the
+    visible box lets them sit close to text and to each other.
+    """
+    left, top, right, bottom = visible_box(overlay)
+    width, height = right - left, bottom - top
+    return Slot(name, (width, height), (margin, image.width - width - margin),
+                (margin, image.height - height - margin))
+
+def text_bands(img, settings, scale=1):
+    """Boxes across img roughly where centered greeting and wish (top) and date (bottom) go"""
+    margin = 20 * scale
+    bands = []
+    # Script fonts draw up to about 1.3x their nominal size tall
+    top = margin
+    if settings['show_text']:
+        top += settings['main_size'] * scale + margin
+    if settings['show_wish']:
+        top += int(settings['wish_size'] * scale * 1.3)
+    if top > margin:
+        bands.append((0, 0, img.width, top))
+    if settings['show_date']:
+        bands.append((0, img.height - int(settings['date_size'] * scale * 1.3) - margin, img.width, img.height))
+    return bands
+
+@timed("overlay")
+def apply_overlay(image, overlay_path, size=0.5, margin=20, avoid=(), position=None, rng=None):
+    """Paste the overlay with its top-left at position, or where a one-overlay plan puts it"""
+    try:
+        overlay = overlay_sprite(image, overlay_path, size)
+        if position is None:
+            slot = overlay_slot("overlay", image, overlay, margin)
+            x, y = plan_layout(image.size, [slot], (rng or random).randrange(PLAN_SEEDS), avoid)["overlay"]
+            left, top, _, _ = visible_box(overlay)
+            position = (x - left, y - top)
+        
+        image.paste(overlay, position, overlay)
+    except Exception as e:
+        logging.error(f"Error applying overlay: {str(e)}")
+    return image
+
+def generate_filename(ext=".jpg", rng=None):
+    now = datetime.datetime.now()
+    future_minutes = (rng or random).randint(1, 10)
+    future_time = now + datetime.timedelta(minutes=future_minutes)
+    return f"Picsart_{future_time.strftime('%y-%m-%d_%H-%M-%S')}{ext}"
+
+# Length of the "Picsart_<timestamp>" part of generate_filename()
+FILENAME_STAMP_LENGTH = len("Picsart_yy-mm-dd_HH-MM-SS")
+
+def output_filename(settings, label=None, rng=None):
+    """generate_filename() with the output format's extension and label as a suffix"""
+    ext = output_extension(settings)
+    return generate_filename(f"_{label}{ext}" if label else ext, rng)
+
+def restamp_filename(filename, rng=None):
+    """filename with a fresh timestamp, keeping what output_filename() appended"""
+    return generate_filename(filename[FILENAME_STAMP_LENGTH:], rng)
+
+# Watermarks go in a bottom corner 70% of the time, anywhere otherwise
+WATERMARK_CANDIDATES = BOTTOM_CORNERS + ANYWHERE
+WATERMARK_WEIGHTS = (0.35, 0.35) + (0.3 / len(ANYWHERE),) * len(ANYWHERE)
+
+def watermark_slot(img, watermark, margin=20):
+    max_x = max(margin, img.width - watermark.width - margin)
+    max_y = max(margin, img.height - watermark.height - margin)
+    return Slot("watermark", watermark.size, (margin, max_x), (margin, max_y),
+                WATERMARK_CANDIDATES, WATERMARK_WEIGHTS)
+
+def get_watermark_position(img, watermark, margin=20, avoid=(), rng=None):
+    return plan_layout(img.size, [watermark_slot(img, watermark, margin)],
+                       (rng or random).randrange(PLAN_SEEDS), avoid)["watermark"]
+
+def decoration_slots(img, settings, margin=20):
+    """Watermark and pet sprites for img (None when off) and Slots for them.
+    
+    The pet goes in either bottom corner; the planner picks the one that
+    leaves the date, the watermark and faces clear.
+    """
+    watermark, pet, slots = None, None, []
+    if settings['use_watermark'] and settings['watermark_image']:
+        with stage("watermark"):
+            watermark = get_thumbnail_sprite(
+                settings['watermark_image'],
+                (img.width//4, img.height//4),
+                settings['watermark_opacity']
+            )
+        slots.append(watermark_slot(img, watermark, margin))
+    
+    if settings['use_coffee_pet'] and settings['selected_pet']:
+        with stage("pet"):
+            pet_path = os.path.join("assets/pets", settings['selected_pet'])
+            if os.path.exists(pet_path):
+                pet = load_asset(pet_path)
+                pet = get_sprite(
+                    pet_path,
+                    (int(img.width * settings['pet_size']), 
+                    int(img.height * settings['pet_size'] * (pet.height/pet.width)))
+                )
+        if pet is not None:
+            y = img.height - pet.height - margin
+            slots.append(Slot("pet", pet.size, (margin, img.width - pet.width - margin), (y, y), BOTTOM_CORNERS))
+    return watermark, pet, slots
+
+def paste_decorations(img, watermark, pet, positions):
+    if watermark is not None:
+        with stage("watermark"):
+            img.paste(watermark, positions["watermark"], watermark)
+    if pet is not None:
+        with stage("pet"):
+            img.paste(pet, positions["pet"], pet)
+
+def draw_lines(img, lines, positions, settings, scale, effect_settings, texture_img=None, rng=None):
+    """Draw each (name, text, font) in lines at positions[name]"""
+    margin = 20 * scale
+    draw = ImageDraw.Draw(img)
+    for name, text, font in lines:
+        x, y = positions[name]
+        if name == "date" and settings['show_day'] and "(" in text:
+            day_part = text[text.index("("):]
+            day_width, _ = get_text_size(draw, day_part, font)
+            if x + day_width > img.width - margin:
+                x = img.width - day_width - margin - 5 * scale
+        
+        effect_settings = apply_text_effect(
+            img, 
+            (x, y), 
+            text, 
+            font,
+            effect_settings,
+            texture_img=texture_img,
+            rng=rng
+        )
+
+# ImageEnhance.Sharpness(1.5) is 1.5 * img - 0.5 * SMOOTH(img); folding that
+# into one kernel (x26) sharpens in a single filter pass
+SHARPEN_KERNEL = ImageFilter.Kernel((3, 3), [-1, -1, -1, -1, 34, -1, -1, -1, -1], scale=26)
+
+@timed("enhance")
+def enhance_image_quality(img):
+    """Sharpness 1.5, contrast 1.1, then brightness 1.1 if the image is dark.
+    
+    Matches chaining ImageEnhance.Sharpness/Contrast/Brightness within a
+    level or two, in two passes over the pixels: one sharpening filter and
+    one lookup table that NumPy builds from the sharpened histogram.
+    """
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    img = img.filter(SHARPEN_KERNEL)
+    hist = np.array(img.histogram(), dtype=np.float64).reshape(3, 256)
+    levels = np.arange(256, dtype=np.float64)
+    
+    # Contrast: extrapolate away from the mean luminance (ITU-R 601-2 like "L")
+    channel_means = hist @ levels / hist[0].sum()
+    mean = int(channel_means @ np.array([0.299, 0.587, 0.114]) + 0.5)
+    lut = np.clip(mean + 1.1 * (levels - mean), 0, 255).astype(np.uint8)
+    
+    # Brightness: histogram()[:100] are the darkest red bins and [-100:]
+    # the brightest blue bins, kept as the test for "dark" images
+    contrasted = np.zeros((3, 256))
+    for band in range(3):
+        np.add.at(contrasted[band], lut, hist[band])
+    if contrasted[0, :100].sum() > contrasted[2, -100:].sum():
+        lut = np.clip(1.1 * lut, 0, 255).astype(np.uint8)
+    
+    return img.point(lut.tolist() * 3)
+
+@timed("upscale")
+def upscale_text_elements(img, scale_factor=2):
+    if scale_factor > 1:
+        new_size = (img.width * scale_factor, img.height * scale_factor)
+        img = img.resize(new_size, Image.LANCZOS)
+    return img
+
+def create_variant(original_img, settings, scale=1, avoid=(), rng=None):
+    """Copy of original_img with text, watermark and pet at places drawn from rng.
+    
+    Everything is measured first and placed by one plan, so no element
+    lands on another or on the avoid boxes (faces, overlays) if it can help it.
+    """
+    rng = rng or random
+    img = original_img.copy()
+    margin = 20 * scale
+    draw = ImageDraw.Draw(img)
+    
+    # Get font - if None, return None to indicate failure
+    font = get_random_font(rng, required_chars(settings))
+    if font is None:
+        return None
+    
+    texture_img = None
+    if settings.get('use_texture', False) and settings.get('texture_image', None):
+        texture_img = settings['texture_image']
+    
+    effect_settings = {
+        'type': settings.get('text_effect', None),
+        'use_texture': settings.get('use_texture', False),
+        'outline_width': settings.get('outline_width', 2) * scale
+    }
+    
+    if effect_settings['type'] == 'full_random':
+        # For full random, we'll use the same color for all text in the image
+        effect_settings['main_color'] = (255, 255, 255)  # Always white for main text
+        effect_settings['outline_color'] = (0, 0, 0)  # Always black for outline
+    
+    lines, slots = [], []
+    if settings['show_text']:
+        font_main = font_at_size(font, settings['main_size'] * scale)
+        text = settings['greeting_type']
+        text_width, _ = get_text_size(draw, text, font_main)
+        
+        slots.append(Slot("text", ink_extent(draw, text, font_main),
+                          (margin, img.width - text_width - margin), (margin, img.height // 3)))
+        lines.append(("text", text, font_main))
+    
+    if settings['show_wish']:
+        font_wish = font_at_size(font, settings['wish_size'] * scale)
+        wish_text = get_random_wish(settings['greeting_type'], rng)
+        wish_width, _ = get_text_size(draw, wish_text, font_wish)
+        
+        x_range = (margin, img.width - wish_width - margin)
+        if settings['show_text']:
+            # A little below the greeting, wherever it lands
+            offset = settings['main_size'] * scale + 10 * scale
+            slots.append(Slot("wish", ink_extent(draw, wish_text, font_wish), x_range,
+                              (offset, offset + 20 * scale), below="text"))
+        else:
+            slots.append(Slot("wish", ink_extent(draw, wish_text, font_wish), x_range,
+                              (margin, img.height // 2)))
+        lines.append(("wish", wish_text, font_wish))
+    
+    if settings['show_date']:
+        font_date = font_at_size(font, settings['date_size'] * scale)
+        
+        date_text = settings_date_text(settings)
+        
+        date_width, date_height = get_text_size(draw, date_text, font_date)
+        
+        date_y = max(margin, img.height - date_height - margin)
+        slots.append(Slot("date", ink_extent(draw, date_text, font_date),
+                          (margin, img.width - date_width - margin), (date_y, date_y)))
+        lines.append(("date", date_text, font_date))
+    
+    watermark, pet, decorations = decoration_slots(img, settings, margin)
+    positions = plan_layout(img.size, slots + decorations, rng.randrange(PLAN_SEEDS), avoid)
+    
+    draw_lines(img, lines, positions, settings, scale, effect_settings, texture_img, rng)
+    paste_decorations(img, watermark, pet, positions)
+    
+    return img.convert("RGB")
+
+@timed("font")
+def adjust_font_size_to_fit(draw, text, max_width, max_height, initial_size, font=None, min_size=10):
+    """Return font at the largest size <= initial_size that fits the box.
+    
+    The first guess scales initial_size by how far the text overflows,
+    estimated from the font index's cached advances without opening the
+    font at initial_size. That is usually within a size or two of the
+    answer; galloping steps bracket it and a binary search closes it.
+    """
+    if font is None:
+        return ImageFont.load_default()
+    
+    measured = {}
+    def measure(size):
+        if size not in measured:
+            measured[size] = get_text_size(draw, text, font_at_size(font, size))
+        return measured[size]
+    
+    def fits(size):
+        text_width, text_height = measure(size)
+        return text_width <= max_width and text_height <= max_height
+    
+    text_width, text_height = get_font_registry().text_size(font.path, text, initial_size) or measure(initial_size)
+    scale = min(max_width / max(text_width, 1), max_height / max(text_height, 1))
+    guess = min(max(int(initial_size * scale), min_size), initial_size)
+    
+    # Bracket the answer so that low fits (or is min_size) and high doesn't,
+    # with initial_size + 1 standing in for "initial_size fits"
+    step = 1
+    if fits(guess):
+        low, high = guess, guess + step
+        while high <= initial_size and fits(high):
+            low, step = high, step * 2
+            high = low + step
+        high = min(high, initial_size + 1)
+    else:
+        low, high = guess - step, guess
+        while low > min_size and not fits(low):
+            high, step = low, step * 2
+            low = high - step
+        low = max(low, min_size)
+    
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid
+    return font_at_size(font, low)
+
+# Centered text unless that covers a face, overlay or another element
+TEXT_ALIGN_WEIGHTS = (0.6, 0.2, 0.2)
+
+def aligned_slot(name, size, canvas_width, width, y_range, margin, below=None):
+    """Slot for a line of text centered, left or right aligned"""
+    return Slot(name, size, (margin, canvas_width - width - margin), y_range,
+                ALIGNED, TEXT_ALIGN_WEIGHTS, below)
+
+def compose_image(img, settings, scale=1, avoid=(), rng=None):
+    """Draw centered greeting, wish and date plus watermark and pet onto img.
+    
+    Text sizes, outlines and margins are multiplied by scale so the layout
+    can be drawn straight onto an image already at output resolution. Text
+    that would cover one of the avoid boxes (faces, overlays), the
+    watermark or the pet moves to the left or right edge instead of the
+    center. Random choices are drawn from rng.
+    """
+    rng = rng or random
+    margin = 20 * scale
+    draw = ImageDraw.Draw(img)
+    font = get_random_font(rng, required_chars(settings))
+    if font is None:
+        raise ValueError("Failed to load any fonts. Please check your fonts folder.")
+    
+    effect_settings = {
+        'type': settings['text_effect'],
+        'use_texture': settings['use_texture'],
+        'outline_width': settings.get('outline_width', 2) * scale
+    }
+    
+    if settings['text_effect'] == 'full_random':
+        effect_settings['main_color'] = (255, 255, 255)  # Always white for main text
+        effect_settings['outline_color'] = (0, 0, 0)  # Always black for outline
+    
+    texture_image = settings.get('texture_image', None)
+    
+    lines, slots = [], []
+    if settings['show_text']:
+        font_main = font_at_size(font, settings['main_size'] * scale)
+        text = settings['greeting_type']
+        text_width, text_height = get_text_size(draw, text, font_main)
+        
+        if text_width > img.width - 2 * margin:
+            font_main = adjust_font_size_to_fit(draw, text, img.width - 2 * margin, img.height//3, settings['main_size'] * scale, font=font)
+            text_width, text_height = get_text_size(draw, text, font_main)
+        
+        slots.append(aligned_slot("text", ink_extent(draw, text, font_main), img.width, text_width,
+                                  (margin, margin), margin))
+        lines.append(("text", text, font_main))
+    
+    if settings['show_wish']:
+        font_wish = font_at_size(font, settings['wish_size'] * scale)
+        wish_text = get_random_wish(settings['greeting_type'], rng)
+        wish_width, wish_height = get_text_size(draw, wish_text, font_wish)
+        
+        if wish_width > img.width - 2 * margin:
+            font_wish = adjust_font_size_to_fit(draw, wish_text, img.width - 2 * margin, img.height//3, settings['wish_size'] * scale, font=font)
+            wish_width, wish_height = get_text_size(draw, wish_text, font_wish)
+        
+        if settings['show_text']:
+            offset = settings['main_size'] * scale + margin
+            slots.append(aligned_slot("wish", ink_extent(draw, wish_text, font_wish), img.width, wish_width,
+                                      (offset, offset), margin, below="text"))
+        else:
+            slots.append(aligned_slot("wish", ink_extent(draw, wish_text, font_wish), img.width, wish_width,
+                                      (margin, margin), margin))
+        lines.append(("wish", wish_text, font_wish))
+    
+    if settings['show_date']:
+        font_date = font_at_size(font, settings['date_size'] * scale)
+        
+        date_text = settings_date_text(settings)
+        
+        date_width, date_height = get_text_size(draw, date_text, font_date)
+        
+        if date_width > img.width - 2 * margin:
+            font_date = adjust_font_size_to_fit(draw, date_text, img.width - 2 * margin, img.height//3, settings['date_size'] * scale, font=font)
+            date_width, date_height = get_text_size(draw, date_text, font_date)
+        
+        date_y = img.height - date_height - margin
+        slots.append(aligned_slot("date", ink_extent(draw, date_text, font_date), img.width, date_width,
+                                  (date_y, date_y), margin))
+        lines.append(("date", date_text, font_date))
+    
+    watermark, pet, decorations = decoration_slots(img, settings, margin)
+    positions = plan_layout(img.size, slots + decorations, rng.randrange(PLAN_SEEDS), avoid,
+                            prefer_likely=True)
+    
+    draw_lines(img, lines, positions, settings, scale, effect_settings, texture_image, rng)
+    paste_decorations(img, watermark, pet, positions)
+    
+    return img
+
+def render_upload(data, settings, digest=None):
+    """Run the full pipeline on one upload's raw bytes.
+    
+    Returns a list of (filename, image) tuples. Everything passed in and
+    returned is picklable so this can run in a worker process.
+    """
+    img = decode_source(data, settings)
+    return render_decoded(img, settings, upload_rng(data, settings, digest))
+
+def upload_rng(data, settings, digest=None):
+    """random.Random for one upload, seeded when settings['seed'] is set.
+    
+    The seed mixes in the upload's hash (digest, if the caller already has
+    it), so the same photo and settings always render the same way. Each
+    upload gets its own generator, so renders on other threads can't
+    disturb the sequence.
+    """
+    if settings.get('seed') is None:
+        return random.Random()
+    return random.Random(image_seed(digest or image_digest(data), settings['seed']))
+
+def render_decoded(img, settings, rng=None):
+    """render_upload from an already decoded working image on.
+    
+    Decoding uses no randomness, so decode_source and this with
+    upload_rng's generator give the same result as render_upload.
+    """
+    rng = rng or random.Random()
+    if settings.get('renditions'):
+        return render_renditions(img, settings, rng)
+    
+    # Enhance once per upload; variants and text are drawn on the result
+    img = enhance_image_quality(img)
+    # Detect on the working image; boxes are scaled to whatever size is drawn on
+    faces = []
+    if settings.get('avoid_faces', True):
+        with stage("faces"):
+            faces = detect_faces(img)
+    return compose_outputs(img, faces, settings, rng=rng)
+
+def render_renditions(img, settings, rng):
+    """One set of outputs per name in settings['renditions'], from one photo.
+    
+    img is the whole photo from decode_for_renditions. It is enhanced and
+    searched for faces once; each rendition is then cropped from it at its
+    aspect ratio and drawn from the same layout seeds, so all of them get
+    the same font, wish, colors and placement choices, fitted to their own
+    canvas. Text, overlay and watermark sprites are shared through the
+    sprite caches. Filenames end in the rendition's name.
+    """
+    img = enhance_image_quality(img)
+    faces = []
+    if settings.get('avoid_faces', True):
+        with stage("faces"):
+            faces = detect_faces(img)
+    
+    # Crop straight to the size text is drawn at, one resample per rendition
+    width = settings.get('working_width')
+    prescaled = bool(width) and settings.get('render_at_output_size', True)
+    if prescaled:
+        width *= settings.get('output_scale', 2)
+    
+    # One seed for the overlays and one per composed image
+    layout_seeds = [rng.getrandbits(64) for _ in range(4 if settings['generate_variants'] else 2)]
+    outputs = []
+    for name in settings['renditions']:
+        with stage("crop"):
+            crop, crop_faces = crop_rendition(img, faces, RENDITIONS[name], width)
+        outputs += compose_outputs(crop, crop_faces, settings, name, layout_seeds, prescaled)
+    return outputs
+
+def compose_outputs(img, faces, settings, label=None, layout_seeds=None, prescaled=False, rng=None):
+    """Outputs as (filename, image) from an enhanced working image.
+    
+    Upscales (unless img and faces are prescaled to output size already),
+    applies the overlays and draws one composed image, or three variants
+    with settings['generate_variants']. Random choices come from rng, or
+    with layout_seeds from a generator reseeded before the overlays and
+    before each output, so another crop of the same photo gets the same
+    random choices.
+    """
+    rng = rng or random.Random()
+    output_scale = settings.get('output_scale', 2)
+    if settings.get('render_at_output_size', True):
+        if not prescaled:
+            img = upscale_text_elements(img, scale_factor=output_scale)
+            faces = [tuple(v * output_scale for v in box) for box in faces]
+        scale, post_scale = output_scale, 1
+    else:
+        scale, post_scale = 1, output_scale
+    
+    if layout_seeds:
+        rng.seed(layout_seeds[0])
+    # Text, watermark and pet keep clear of the overlays as well as faces
+    avoid = list(faces)
+    if settings['use_overlay']:
+        overlays = []
+        for overlay_file in settings['overlay_files']:
+            overlay_path = os.path.join("assets/overlays", settings['overlay_theme'], overlay_file)
+            if not os.path.exists(overlay_path):
+                logging.warning(f"Overlay file not found: {overlay_path}")
+                continue
+            try:
+                overlays.append((overlay_path, overlay_sprite(img, overlay_path, settings['overlay_size'])))
+            except Exception as e:
+                logging.error(f"Error applying overlay: {str(e)}")
+        
+        # Planned together and away from where the text usually goes, so
+        # overlays neither stack up nor sit under the greeting
+        slots = [overlay_slot(f"overlay{i}", img, sprite, 20 * scale) for i, (_, sprite) in enumerate(overlays)]
+        positions = plan_layout(img.size, slots, rng.randrange(PLAN_SEEDS),
+                                list(faces) + text_bands(img, settings, scale))
+        for slot, (overlay_path, sprite) in zip(slots, overlays):
+            x, y = positions[slot.name]
+            left, top, _, _ = visible_box(sprite)
+            img = apply_overlay(img, overlay_path, settings['overlay_size'], position=(x - left, y - top))
+            avoid.append((x, y, x + slot.size[0], y + slot.size[1]))
+    
+    if settings['generate_variants']:
+        variants = []
+        for i in range(3):
+            if layout_seeds:
+                rng.seed(layout_seeds[i + 1])
+            variant = create_variant(img, settings, scale, avoid, rng)
+            if variant is not None:  # Only add if font selection succeeded
+                variants.append((output_filename(settings, label, rng), upscale_text_elements(variant, scale_factor=post_scale)))
+        return variants
+    
+    if layout_seeds:
+        rng.seed(layout_seeds[1])
+    img = compose_image(img, settings, scale, avoid, rng)
+    return [(output_filename(settings, label, rng), upscale_text_elements(img, scale_factor=post_scale))]
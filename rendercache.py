@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+import tempfile
+
+from fonts import get_font_registry
+
+# Bump when a code change makes the same inputs render differently, so
+# stale entries stop matching
+CACHE_VERSION = 4
+
+# Private to the user, so nobody else can plant entries that come back as outputs
+DEFAULT_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "shivam-tool", "render_cache"))
+DEFAULT_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MB", "1024")) * 1024 * 1024
+
+ENTRY_MAGIC = b"RENDERCACHE1\n"
+ENTRY_EXT = ".bin"
+
+def _dump_entry(f, outputs):
+    """Write [(filename, data, preview)] as magic, a JSON index and the raw bytes"""
+    index = json.dumps([[filename, len(data), None if preview is None else len(preview)]
+                        for filename, data, preview in outputs]).encode()
+    f.write(ENTRY_MAGIC + len(index).to_bytes(4, "big") + index)
+    for _, data, preview in outputs:
+        f.write(data)
+        if preview is not None:
+            f.write(preview)
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated entry")
+    return data
+
+def _load_entry(f):
+    if f.read(len(ENTRY_MAGIC)) != ENTRY_MAGIC:
+        raise ValueError("not a render cache entry")
+    index = json.loads(_read_exact(f, int.from_bytes(_read_exact(f, 4), "big")))
+    outputs = []
+    for filename, data_size, preview_size in index:
+        if not isinstance(filename, str):
+            raise ValueError("bad filename")
+        data = _read_exact(f, data_size)
+        preview = _read_exact(f, preview_size) if preview_size is not None else None
+        outputs.append((filename, data, preview))
+    return outputs
+
+def image_digest(data):
+    return hashlib.sha256(data).digest()
+
+def image_seed(digest, seed):
+    """Per-image random seed derived from the upload's hash and the batch seed"""
+    return int.from_bytes(hashlib.sha256(digest + str(seed).encode()).digest()[:8], "big")
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return [path, None, None]
+
+def _normalize(value):
+    """JSON-able stand-in for a settings value; images become a content hash"""
+    if hasattr(value, 'tobytes') and hasattr(value, 'mode'):
+        digest = hashlib.sha256(value.tobytes())
+        return ["image", value.mode, list(value.size), digest.hexdigest()]
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+def asset_versions(settings):
+    """(path, size, mtime) of every asset file the settings can draw from"""
+    versions = [_file_version(path) for path in get_font_registry().fonts]
+    versions.append(_file_version("haarcascade_frontalface_default.xml"))
+    if settings.get('use_overlay'):
+        versions += [_file_version(os.path.join("assets/overlays", settings['overlay_theme'], name))
+                     for name in settings.get('overlay_files', [])]
+    if settings.get('use_coffee_pet') and settings.get('selected_pet'):
+        versions.append(_file_version(os.path.join("assets/pets", settings['selected_pet'])))
+    return versions
+
+def settings_fingerprint(settings, preview_size=None):
+    """Hash of everything besides the image bytes that decides the output.
+
+    Computed once per batch; the date is part of it when the date is drawn.
+    """
+    normalized = {
+        'version': CACHE_VERSION,
+        'settings': _normalize(settings),
+        'assets': asset_versions(settings),
+        'preview_size': _normalize(preview_size),
+        'date': datetime.date.today().isoformat() if settings.get('show_date') else None
+    }
+    return hashlib.sha256(repr(normalized).encode()).hexdigest()
+
+class RenderCache:
+    """Rendered outputs on disk, keyed by hash(image bytes, settings fingerprint).
+
+    Each entry is one file of [(filename, encoded bytes, preview bytes)]
+    in a plain length-prefixed format, never pickle, and the directory is
+    created private to the user. A hit touches the file's mtime, and when the directory grows
+    past max_bytes the least recently used entries are deleted. Writes go through a temp
+    file and os.replace, so concurrent workers never see partial entries.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._bytes = None
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def key(self, digest, fingerprint):
+        return hashlib.sha256(digest + fingerprint.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_EXT)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                outputs = _load_entry(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Dropping unreadable render cache entry {key}: {str(e)}")
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another worker since; the entry read is still good
+            pass
+        return outputs
+
+    def put(self, key, outputs):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                _dump_entry(f, outputs)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # A full or read-only disk only costs the cache, not the render
+            logging.warning(f"Could not write render cache entry {key}: {str(e)}")
+            return
+
+        try:
+            if self._bytes is None:
+                self._bytes = self.size()
+            else:
+                self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self.evict()
+        except OSError:
+            # The entry was evicted by another worker already; recount next time
+            self._bytes = None
+
+    def _entries(self):
+        """(mtime, size, path) of every entry.
+        
+        Other workers add and evict entries concurrently, so files that
+        vanish while listing are skipped.
+        """
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(ENTRY_EXT):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        yield stat.st_mtime, stat.st_size, entry.path
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target=0.9):
+        """Delete least recently used entries until under target * max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * target:
+                break
+            self._remove(path)
+            total -= size
+        self._bytes = total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for _, _, path in list(self._entries()):
+            self._remove(path)
+        self._bytes = 0
+
+_cache = None
+
+def get_render_cache():
+    global _cache
+    if _cache is None:
+        _cache = RenderCache()
+    return _cache
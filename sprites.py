@@ -0,0 +1,136 @@
+from PIL import Image, ImageChops, ImageDraw, ImageEnhance, ImageOps
+import logging
+from collections import OrderedDict
+
+class SpriteCache:
+    """LRU of decoded, resized RGBA sprites bounded by their pixel memory.
+
+    Every upload in a batch is cropped to the same ratio, so overlays, pets
+    and the watermark are resized to the same few target sizes over and
+    over; caching them turns each compositing step into a plain paste.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, source=None):
+        """Return the sprite for key, calling build() to make it on a miss.
+
+        source, when given, is the object the sprite was made from; an entry
+        made from a different object is rebuilt even if the key matches.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is source:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        sprite = build()
+        if entry is not None:
+            self._bytes -= entry[2]
+        # build() may return (image, extra) to cache metadata with the image
+        image = sprite[0] if isinstance(sprite, tuple) else sprite
+        cost = image.width * image.height * len(image.getbands())
+        self._entries[key] = (source, sprite, cost)
+        self._entries.move_to_end(key)
+        self._bytes += cost
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, _, evicted_cost) = self._entries.popitem(last=False)
+            self._bytes -= evicted_cost
+        return sprite
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'bytes': self._bytes
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+_cache = SpriteCache()
+_text_cache = SpriteCache(max_bytes=64 * 1024 * 1024)
+
+def get_sprite_cache():
+    return _cache
+
+def get_text_sprite_cache():
+    return _text_cache
+
+def _with_opacity(image, opacity):
+    if opacity < 1.0:
+        image = image.copy()
+        alpha = image.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
+        image.putalpha(alpha)
+    return image
+
+def load_asset(path):
+    """Decoded RGBA image at its native size"""
+    def build():
+        with Image.open(path) as img:
+            return img.convert("RGBA")
+    return _cache.get((path, None, 1.0), build)
+
+def get_sprite(path, target_size, opacity=1.0):
+    """RGBA asset at path resized (LANCZOS) to target_size with opacity applied"""
+    def build():
+        logging.debug(f"Building sprite {path} at {target_size}")
+        return _with_opacity(load_asset(path).resize(target_size, Image.LANCZOS), opacity)
+    return _cache.get((path, tuple(target_size), opacity), build)
+
+def get_thumbnail_sprite(image, bound, opacity=1.0):
+    """In-memory RGBA image with opacity applied, thumbnailed to fit bound"""
+    def build():
+        sprite = _with_opacity(image, opacity)
+        if sprite is image:
+            sprite = image.copy()
+        sprite.thumbnail(bound)
+        return sprite
+    return _cache.get(("thumbnail", id(image), tuple(bound), opacity), build, source=image)
+
+def get_canvas_texture(texture, canvas_size):
+    """RGB texture scaled and center-cropped to cover canvas_size"""
+    def build():
+        return ImageOps.fit(texture.convert("RGB"), canvas_size, Image.LANCZOS)
+    return _cache.get(("texture", id(texture), tuple(canvas_size)), build, source=texture)
+
+def get_text_sprite(text, font, fill, stroke_width=0, stroke_fill=None):
+    """Tight-cropped RGBA rendering of text and its offset from the draw origin.
+    
+    Alpha is the coverage mask of the (stroked) text and color is drawn on
+    an opaque background rather than a transparent image, so the sprite has
+    straight alpha and pastes without dark fringes.
+    """
+    def build():
+        left, top, right, bottom = font.getbbox(text, stroke_width=stroke_width)
+        size = (max(right - left, 1), max(bottom - top, 1))
+        origin = (-left, -top)
+        
+        alpha = Image.new("L", size, 0)
+        ImageDraw.Draw(alpha).text(origin, text, font=font, fill=255,
+                                   stroke_width=stroke_width, stroke_fill=255)
+        if stroke_width:
+            # Draw on the outline color so edge pixels blend only into it
+            color = Image.new("RGB", size, stroke_fill)
+            ImageDraw.Draw(color).text(origin, text, font=font, fill=fill,
+                                       stroke_width=stroke_width, stroke_fill=stroke_fill)
+            # FreeType's stroker can leave holes where contours overlap
+            fill_mask = Image.new("L", size, 0)
+            ImageDraw.Draw(fill_mask).text(origin, text, font=font, fill=255)
+            alpha = ImageChops.lighter(alpha, fill_mask)
+        else:
+            color = Image.new("RGB", size, fill)
+        color.putalpha(alpha)
+        return color, (left, top)
+    
+    return _text_cache.get((font.path, font.size, text, fill, stroke_width, stroke_fill), build)
@@ -0,0 +1,88 @@
+import os
+import time
+import shutil
+import weakref
+import tempfile
+
+# Temp dirs (and export ZIPs) made for a session's outputs start with this
+TEMP_PREFIX = "generated_"
+# Older leftovers belong to no live session
+STALE_SECONDS = 24 * 60 * 60
+
+def sweep_stale(directory=None, max_age=STALE_SECONDS):
+    """Delete TEMP_PREFIX entries in directory (default: the temp dir) untouched for max_age seconds.
+
+    Stores and exporters clean up when their session is collected; this
+    catches what a killed or crashed server left behind.
+    """
+    directory = directory or tempfile.gettempdir()
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        if not name.startswith(TEMP_PREFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.lstat(path).st_mtime > cutoff:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+class ResultStore:
+    """Generated outputs kept as encoded JPEG bytes plus a preview thumbnail.
+
+    With spill_dir set, the full-size bytes are written there and only the
+    thumbnails stay in memory; data() reads the full image back on demand.
+    The directory is removed by clear() or once the store is garbage
+    collected, e.g. when its session ends or a rerun drops it mid-batch.
+    """
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self._cleanup = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._cleanup = weakref.finalize(self, shutil.rmtree, spill_dir, True)
+        self._items = []
+
+    @classmethod
+    def spilled(cls):
+        """Store that spills full-size outputs to a fresh temp directory"""
+        return cls(spill_dir=tempfile.mkdtemp(prefix=TEMP_PREFIX))
+
+    def add(self, filename, data, preview=None):
+        if self.spill_dir is not None:
+            path = os.path.join(self.spill_dir, f"{len(self._items)}_{os.path.basename(filename)}")
+            with open(path, "wb") as f:
+                f.write(data)
+            data = path
+        self._items.append((filename, data, preview))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def filename(self, index):
+        return self._items[index][0]
+
+    def data(self, index):
+        data = self._items[index][1]
+        if self.spill_dir is not None:
+            with open(data, "rb") as f:
+                return f.read()
+        return data
+
+    def preview(self, index):
+        """Thumbnail bytes, or the full image if no thumbnail was made"""
+        preview = self._items[index][2]
+        return preview if preview is not None else self.data(index)
+
+    def clear(self):
+        self._items = []
+        if self._cleanup is not None:
+            self._cleanup()
@@ -0,0 +1,40 @@
+import os
+import threading
+
+import pytest
+
+import engine
+import rendercache
+from conftest import DATA
+from render import DEFAULT_SETTINGS
+
+@pytest.fixture(autouse=True)
+def render_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(rendercache, "_cache", rendercache.RenderCache(str(tmp_path)))
+
+def render(settings, count=3):
+    with open(os.path.join(DATA, "astronaut.jpg"), "rb") as f:
+        data = f.read()
+    uploads = [(f"{i}.jpg", data) for i in range(count)]
+    results = sorted(engine.iter_batch(uploads, settings, workers=1))
+    return [[encoded for _, encoded, _ in outputs] for _, _, outputs, _, _ in results]
+
+def test_concurrent_in_process_batches_keep_their_settings():
+    """App sessions share a process; one batch's settings must not leak into another's"""
+    jpeg = dict(DEFAULT_SETTINGS, working_width=270, seed=1, output_format="jpeg")
+    webp = dict(DEFAULT_SETTINGS, working_width=270, seed=2, output_format="webp")
+    expected = {"jpeg": render(jpeg), "webp": render(webp)}
+    rendercache.get_render_cache().clear()
+
+    results = {}
+    threads = [threading.Thread(target=lambda s=s: results.__setitem__(s['output_format'], render(s)))
+               for s in (jpeg, webp)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(data.startswith(b"\xff\xd8") for outputs in results["jpeg"] for data in outputs)
+    assert all(data[8:12] == b"WEBP" for outputs in results["webp"] for data in outputs)
+    # Seeded renders come out the same as when each batch ran alone
+    assert results == expected
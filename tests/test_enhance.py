@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance
+
+from conftest import DATA
+from render import enhance_image_quality
+from bench import synthetic_photo
+
+def enhance_reference(img):
+    """The original ImageEnhance chain the fused pass replaces"""
+    img = ImageEnhance.Sharpness(img.convert("RGB")).enhance(1.5)
+    img = ImageEnhance.Contrast(img).enhance(1.1)
+    hist = img.histogram()
+    if sum(hist[:100]) > sum(hist[-100:]):
+        img = ImageEnhance.Brightness(img).enhance(1.1)
+    return img
+
+def astronaut():
+    return Image.open(os.path.join(DATA, "astronaut.jpg")).convert("RGB")
+
+@pytest.mark.parametrize("make", [
+    astronaut,
+    lambda: synthetic_photo(0.5),
+    # Dark enough to take the brightness branch
+    lambda: Image.eval(astronaut(), lambda v: v // 3),
+    lambda: astronaut().convert("L")
+], ids=["photo", "synthetic", "dark", "grayscale"])
+def test_matches_enhance_chain(make):
+    img = make()
+    fused = np.asarray(enhance_image_quality(img), dtype=np.int16)
+    reference = np.asarray(enhance_reference(img), dtype=np.int16)
+    assert fused.shape == reference.shape
+    assert np.abs(fused - reference).max() <= 3
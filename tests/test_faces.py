@@ -0,0 +1,25 @@
+import os
+
+from PIL import Image
+
+from conftest import DATA
+from render import decode_upload, enhance_image_quality
+from faces import detect_faces
+
+# The face in astronaut.jpg (the scikit-image sample photo) at 1080x1440
+ASTRONAUT_FACE = (300, 170, 590, 470)
+
+def test_detects_face_in_portrait():
+    """Same path as the pipeline: decoded, enhanced, 3:4 at working size"""
+    with open(os.path.join(DATA, "astronaut.jpg"), "rb") as f:
+        img = enhance_image_quality(decode_upload(f.read(), 1080))
+    img = img.resize((1080, 1440), Image.LANCZOS)
+
+    faces = detect_faces(img)
+    assert len(faces) == 1
+    left, top, right, bottom = faces[0]
+    center = ((left + right) / 2, (top + bottom) / 2)
+    assert ASTRONAUT_FACE[0] < center[0] < ASTRONAUT_FACE[2]
+    assert ASTRONAUT_FACE[1] < center[1] < ASTRONAUT_FACE[3]
+    # Covers most of the face, not just a feature of it
+    assert right - left > 0.6 * (ASTRONAUT_FACE[2] - ASTRONAUT_FACE[0])
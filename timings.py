@@ -0,0 +1,166 @@
+"""Per-stage wall-clock timings for the render pipeline.
+
+Pipeline functions are wrapped with timed("stage") or a `with stage(...)`
+block; each records one (stage, start, duration, pid, tid) event in a per-thread
+list that the engine takes after every image. Nested stages only record the
+outermost one, so stage totals add up to no more than the image's time.
+The cost is two perf_counter() calls per stage.
+"""
+import io
+import os
+import time
+import pstats
+import threading
+import functools
+from contextlib import contextmanager
+
+import numpy as np
+
+STAGES = ["decode", "crop", "enhance", "faces", "layout", "overlay", "font", "text",
+          "watermark", "pet", "upscale", "encode", "zip"]
+
+_local = threading.local()
+
+def _state():
+    if not hasattr(_local, 'events'):
+        _local.events = []
+        _local.depth = 0
+        _local.tid = threading.get_ident()
+    return _local
+
+@contextmanager
+def stage(name):
+    state = _state()
+    state.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        state.depth -= 1
+        if state.depth == 0:
+            state.events.append((name, start, time.perf_counter() - start, os.getpid(), state.tid))
+
+def timed(name):
+    """Decorator recording every call of the function as stage name"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def take_events():
+    """Events recorded on this thread since the last call"""
+    state = _state()
+    events, state.events = state.events, []
+    return events
+
+class _LoadedStats:
+    """Adapter so pstats.Stats can load a raw cProfile stats dict"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def merge_cprofile(raw_stats):
+    """Merge several raw cProfile stats dicts (Profile.stats) into one"""
+    merged = pstats.Stats(_LoadedStats(raw_stats[0]))
+    for stats in raw_stats[1:]:
+        merged.add(_LoadedStats(stats))
+    return merged.stats
+
+class BatchProfile:
+    """Stage timings of every image in a batch, plus merged cProfile stats.
+
+    perf_counter() is a system-wide monotonic clock on Linux and macOS, so
+    events from different worker processes line up in the trace.
+    """
+
+    def __init__(self):
+        self.images = []
+        self._cprofile = None
+
+    def add(self, name, events, cprofile=None):
+        """Record one image's events; cprofile is a raw cProfile stats dict"""
+        self.images.append((name, list(events)))
+        if cprofile:
+            if self._cprofile is None:
+                self._cprofile = pstats.Stats(_LoadedStats(cprofile))
+            else:
+                self._cprofile.add(_LoadedStats(cprofile))
+
+    def __bool__(self):
+        return bool(self.images)
+
+    def _per_image(self):
+        """[(name, {stage: seconds})] with repeated stages summed"""
+        rows = []
+        for name, events in self.images:
+            stages = {}
+            for stage_name, _, duration, _, _ in events:
+                stages[stage_name] = stages.get(stage_name, 0.0) + duration
+            rows.append((name, stages))
+        return rows
+
+    def summary(self):
+        """Per stage: total seconds, mean and p95 ms over images that ran it"""
+        per_stage = {}
+        for _, stages in self._per_image():
+            for stage_name, seconds in stages.items():
+                per_stage.setdefault(stage_name, []).append(seconds)
+        order = STAGES + sorted(set(per_stage) - set(STAGES))
+        return [{
+            'stage': stage_name,
+            'images': len(per_stage[stage_name]),
+            'total_s': float(np.sum(per_stage[stage_name])),
+            'mean_ms': float(np.mean(per_stage[stage_name])) * 1000,
+            'p95_ms': float(np.percentile(per_stage[stage_name], 95)) * 1000
+        } for stage_name in order if stage_name in per_stage]
+
+    def slowest(self, count=5):
+        """The count images with the most recorded time, as (name, seconds)"""
+        totals = [(name, sum(stages.values())) for name, stages in self._per_image()]
+        return sorted(totals, key=lambda item: item[1], reverse=True)[:count]
+
+    def to_json(self):
+        return {
+            'summary': self.summary(),
+            'images': [{'name': name, 'total_s': sum(stages.values()), 'stages': stages}
+                       for name, stages in self._per_image()]
+        }
+
+    def to_chrome_trace(self):
+        """Trace Event Format, for chrome://tracing or ui.perfetto.dev"""
+        starts = [start for _, events in self.images for _, start, _, _, _ in events]
+        origin = min(starts) if starts else 0.0
+        return {'traceEvents': [{
+            'name': stage_name,
+            'cat': "render",
+            'ph': "X",
+            'ts': (start - origin) * 1e6,
+            'dur': duration * 1e6,
+            'pid': pid,
+            'tid': tid,
+            'args': {'image': name}
+        } for name, events in self.images for stage_name, start, duration, pid, tid in events]}
+
+    @property
+    def has_cprofile(self):
+        return self._cprofile is not None
+
+    def cprofile_report(self, limit=30, sort="cumulative"):
+        """pstats listing of the merged cProfile data, or "" if none"""
+        if self._cprofile is None:
+            return ""
+        out = io.StringIO()
+        self._cprofile.stream = out
+        self._cprofile.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump_cprofile(self, path):
+        """Write merged cProfile data for snakeviz, pstats, etc."""
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(path)